@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Near-duplicate detection benchmark: the listings of the corpus plus copies of
+some of them, reposted on imot.bg under another URL (another adv, the same
+text) and copied to ues.bg (the names transliterated).
+
+    python bench/bench_dedup.py -n 1000 2000 4000 --copies 0.2
+
+For every size: the copies found and the false merges, the same_listing()
+checks made through the LSH buckets and their time against checking every
+pair (sizes up to --pairwise only), and the apartments left to geocode.
+"""
+
+from __future__ import print_function
+
+import json
+import time
+import random
+import argparse
+
+from common import load_scanner, listing_urls
+from stub_server import render_listing, listing_values
+
+IMOT = 'http://www.imot.bg/pcgi/imot.cgi?act=5&adv=copy%05d&slink=stub&f1=1'
+UES = 'http://ues.bg/en/offers/9%05d-apartment-for-rent'
+
+# imot.bg districts as ues.bg would write them
+LATIN = {u'Лозенец': u'Lozenets', u'Изток': u'Iztok', u'Иван Вазов': u'Ivan Vazov', u'Младост': u'Mladost'}
+
+
+def copies(urls, share, rnd):
+    """[(copy url, page values, original url)] of a share of the imot.bg listings"""
+    found = []
+    for url in urls:
+        if 'imot.bg' not in url or rnd.random() >= share:
+            continue
+        values = listing_values(url, 'imot.bg')
+        n = len(found)
+        # a 1-room (studio) listing has 1 bedroom on ues.bg, 2 rooms
+        if values['district'] in LATIN and values['rooms'] > 1 and rnd.random() < 0.5:
+            copy = dict(listing_values(UES % n, 'ues.bg'), rooms=values['rooms'], bedrooms=values['bedrooms'],
+                        sqm=values['sqm'], price=values['price'], floor=values['floor'],
+                        floor_max=values['floor_max'], district=LATIN[values['district']])
+            found.append((UES % n, copy, url))
+        else:
+            found.append((IMOT % n, dict(values, adv=listing_values(IMOT % n, 'imot.bg')['adv']), url))
+    return found
+
+
+def scan(scanner, url, values=None):
+    body, charset = render_listing(url, values=values)
+    a = scanner.Apartment(0, url)
+    a.scan(body.decode(charset).split(u'\n'))
+    return a
+
+
+def run(scanner, n, args, rnd):
+    urls = listing_urls(n)
+    extra = copies(urls, args.copies, rnd)
+    apartments = [scan(scanner, url) for url in urls] + [scan(scanner, url, values) for url, values, _ in extra]
+    for i, a in enumerate(apartments, 1):
+        a.id = i
+    original = dict((url, orig) for url, _, orig in extra)
+
+    checks = [0]
+    same_listing = scanner.same_listing
+
+    def counted(a, b):
+        checks[0] += 1
+        return same_listing(a, b)
+
+    scanner.same_listing = counted
+    try:
+        duplicates = scanner.Duplicates()
+        started = time.time()
+        merged = [(a, duplicates.canonical(a)) for a in apartments]
+        elapsed = time.time() - started
+        result = {'listings': len(apartments), 'copies': len(extra)}
+        found = [(a.url, c.url) for a, c in merged if c]
+        result['found'] = sum(1 for url, c in found if original.get(url) == c)
+        result['false_merges'] = len(found) - result['found']
+        result['lsh'] = {'checks': checks[0], 'seconds': round(elapsed, 4)}
+
+        if len(apartments) <= args.pairwise:
+            checks[0] = 0
+            started = time.time()
+            for i, a in enumerate(apartments):
+                for b in apartments[:i]:
+                    counted(a, b)
+            result['pairwise'] = {'checks': checks[0], 'seconds': round(time.time() - started, 4)}
+    finally:
+        scanner.same_listing = same_listing
+
+    result['geocoded_apartments'] = {'all': len(apartments), 'deduplicated': len(apartments) - len(found)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="near-duplicate detection benchmark")
+    parser.add_argument('-n', '--listings', default=[1000, 2000, 4000], type=int, nargs='+',
+                        help="corpus sizes to compare")
+    parser.add_argument('--copies', default=0.2, type=float, help="share of the imot.bg listings copied")
+    parser.add_argument('--pairwise', default=2500, type=int, help="check every pair up to this many listings")
+    args = parser.parse_args()
+
+    scanner = load_scanner()
+    results = [run(scanner, n, args, random.Random(n)) for n in args.listings]
+    print(json.dumps({'benchmark': 'dedup', 'results': results}, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cold-cache fetch benchmark: serial run vs --jobs N against the local stub server.
+
+    python bench/bench_fetch.py -n 200 --delay 0.1 --jobs 1 8 16
+
+Every run starts with an empty page cache and must produce the same report
+as the serial run.
+
+    python bench/bench_fetch.py --http -n 300 --delay 0.01 --connect-delay 0.05
+
+--http compares the scanner HTTP client (kept-alive connections, gzip) with
+a urllib request per page, the way pages were fetched before: serial
+fetches of the whole pages, their time, the connections opened and the bytes
+sent by the stub. --connect-delay emulates the TCP/TLS handshake.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from common import SCANNER, CONFIG, listing_urls, load_scanner
+from stub_server import StubServer
+
+
+def make_links(path, n):
+    with open(path, 'w') as f:
+        for url in listing_urls(n):
+            f.write(url + '\n')
+
+
+def run(links, jobs, host_jobs, proxy, workdir):
+    tmp = tempfile.mkdtemp(dir=workdir)
+    out = os.path.join(tmp, 'report.html')
+    env = dict(os.environ, http_proxy=proxy, TMPDIR=tmp)
+    cmd = [sys.executable, SCANNER, '-c', CONFIG, '-l', links, '-w', out,
+           '-j', str(jobs), '--host-jobs', str(host_jobs)]
+    started = time.time()
+    subprocess.check_call(cmd, env=env)
+    elapsed = time.time() - started
+    with open(out, 'rb') as f:
+        report = f.read()
+    return elapsed, report
+
+
+def bench_http(server, args):
+    os.environ['http_proxy'] = server.proxy
+    scanner = load_scanner()
+    urls = listing_urls(args.listings)
+    results = {}
+    for name, fetch in (('urllib', lambda url: urlopen(url).read()),
+                        ('keepalive', lambda url: scanner.url_open(url).read())):
+        before = json.loads(server.stats.to_json())
+        started = time.time()
+        size = sum(len(fetch(url)) for url in urls)
+        elapsed = time.time() - started
+        after = json.loads(server.stats.to_json())
+        results[name] = {'seconds': round(elapsed, 3), 'pages_per_sec': round(len(urls) / elapsed, 1),
+                         'connections': after['connections'] - before['connections'],
+                         'bytes_sent': sum(after['bytes_sent'].values()) - sum(before['bytes_sent'].values()),
+                         'page_bytes': size}
+    scanner.HTTP.close()
+    results['speedup'] = round(results['urllib']['seconds'] / results['keepalive']['seconds'], 1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fetch engine benchmark")
+    parser.add_argument('-n', '--listings', default=100, type=int, help="number of listings")
+    parser.add_argument('--delay', default=0.1, type=float, help="stub server response delay, seconds")
+    parser.add_argument('--jobs', default=[1, 4, 8], type=int, nargs='+', help="--jobs values to compare")
+    parser.add_argument('--host-jobs', default=4, type=int, help="--host-jobs value")
+    parser.add_argument('--connect-delay', default=0.0, type=float, help="stub server new connection delay, seconds")
+    parser.add_argument('--http', action='store_true', help="compare the HTTP clients instead of --jobs values")
+    args = parser.parse_args()
+
+    server = StubServer(delay=args.delay, connect_delay=args.connect_delay).start()
+    if args.http:
+        try:
+            print(json.dumps({'benchmark': 'http', 'delay': args.delay, 'connect_delay': args.connect_delay,
+                              'listings': args.listings, 'results': bench_http(server, args)},
+                             indent=2, sort_keys=True))
+        finally:
+            server.shutdown()
+        return
+
+    workdir = tempfile.mkdtemp(prefix='aparts-bench-')
+    try:
+        links = os.path.join(workdir, 'links.txt')
+        make_links(links, args.listings)
+
+        results = []
+        reference = None
+        for jobs in args.jobs:
+            elapsed, report = run(links, jobs, args.host_jobs, server.proxy, workdir)
+            if reference is None:
+                reference = report
+            results.append({'jobs': jobs, 'host_jobs': args.host_jobs, 'listings': args.listings,
+                            'seconds': round(elapsed, 3), 'pages_per_sec': round(args.listings / elapsed, 1),
+                            'same_report': report == reference})
+        print(json.dumps({'benchmark': 'fetch', 'delay': args.delay, 'results': results,
+                          'server': json.loads(server.stats.to_json())}, indent=2, sort_keys=True))
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
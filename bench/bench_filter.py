@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Listing filters benchmark: whole scanner runs against the local stub server
+and geocoder, without and with --filter, cold caches.
+
+    python bench/bench_filter.py -n 300 --geocode-rate 20 --filter "rooms=2-3" "price<=1500" "district=Лозенец"
+
+Reported for every run: the wall time, the geocoding requests, the parse
+time (the scan stage of --profile), the pages parsed only up to a failing
+filter, the listings filtered out and the listings of the report.
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from common import SCANNER, CONFIG, listing_urls
+from stub_server import StubServer
+
+
+def run(server, args, filters):
+    workdir = tempfile.mkdtemp(prefix='aparts-bench-')
+    try:
+        links = os.path.join(workdir, 'links.txt')
+        with open(links, 'w') as f:
+            f.write('\n'.join(listing_urls(args.listings)) + '\n')
+        report = os.path.join(workdir, 'report.html')
+        profile = os.path.join(workdir, 'profile.json')
+        env = dict(os.environ, http_proxy=server.proxy, no_proxy='127.0.0.1', TMPDIR=workdir)
+        cmd = [sys.executable, SCANNER, '-c', CONFIG, '-l', links, '-j', str(args.jobs), '-w', report,
+               '--profile', profile, '-d', 'InterContinental Sofia', '--geocoder', server.proxy,
+               '--geocode-rate', str(args.geocode_rate)]
+        for f in filters:
+            cmd += ['--filter', f]
+
+        geocoded = len(server.stats.geocodes)
+        started = time.time()
+        subprocess.check_call(cmd, env=env)
+        elapsed = time.time() - started
+
+        with open(report, 'rb') as f:
+            listings = len(re.findall(b"<tr class='grid'", f.read()))
+        with open(profile) as f:
+            figures = json.load(f)
+        counters = figures['counters'].get('filters', {})
+        return {'seconds': round(elapsed, 2), 'geocoding_requests': len(server.stats.geocodes) - geocoded,
+                'parse_seconds': figures['stages'].get('scan', {}).get('seconds'),
+                'stopped_parsing': counters.get('stopped', 0), 'filtered_out': counters.get('rejected', 0),
+                'report_listings': listings}
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="scanner runs without and with listing filters")
+    parser.add_argument('-n', '--listings', default=300, type=int, help="listings to scan")
+    parser.add_argument('-j', '--jobs', default=8, type=int, help="scanner --jobs")
+    parser.add_argument('--geocode-rate', default=20.0, type=float, help="scanner --geocode-rate")
+    parser.add_argument('--filter', default=['rooms=2-3', 'price<=1500', 'district=Лозенец,Lozenets'], nargs='+',
+                        help="the filters of the filtered run")
+    args = parser.parse_args()
+
+    server = StubServer().start()
+    try:
+        results = {'benchmark': 'filter', 'python': sys.version.split()[0], 'filters': args.filter,
+                   'unfiltered': run(server, args, []), 'filtered': run(server, args, args.filter)}
+    finally:
+        server.shutdown()
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
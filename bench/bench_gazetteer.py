@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Offline gazetteer benchmark: Gazetteer.locate() of made-up listing addresses
+against a made-up gazetteer of a city.
+
+    python bench/bench_gazetteer.py -n 20000 --streets 3000 --districts 40
+
+The listing streets come with house numbers, entrances and type words, some
+have a typo, some are transliterated to latin and some aren't in the
+gazetteer at all. Reported: the lookups per second (of new addresses and of
+repeated ones), the addresses found, found wrong (another street) and not
+found, i.e. left to the remote geocoder.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from common import load_scanner
+
+SYLLABLES = ["ва", "ли", "ко", "ра", "ни", "ст", "бо", "ри", "ма", "це", "ло", "тен", "гра", "дин", "во", "зла",
+             "ту", "хри", "ша", "чер"]
+# share of the listings with: a typo, latin names, a street the gazetteer doesn't have
+TYPOS = 0.1
+LATIN = 0.1
+UNKNOWN = 0.05
+
+
+def random_name(rnd, words=(1, 2)):
+    return " ".join("".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))).capitalize()
+                    for _ in range(rnd.randint(*words)))
+
+
+def typo(rnd, name):
+    i = rnd.randrange(len(name))
+    return name[:i] + rnd.choice("аеиоу") + name[i + 1:]
+
+
+def latin(scanner, name):
+    return "".join(scanner.TRANSLIT.get(c.lower(), c) for c in name).title()
+
+
+def random_point(rnd):
+    return round(rnd.uniform(42.62, 42.76), 6), round(rnd.uniform(23.22, 23.43), 6)
+
+
+def gazetteer(rnd, args):
+    """[(district, street, (lat, lon))], the district centres have no street"""
+    districts = sorted(set(random_name(rnd, (1, 1)) for _ in range(args.districts)))
+    entries = [(d, "", random_point(rnd)) for d in districts]
+    streets = set()
+    while len(streets) < args.streets:
+        streets.add(random_name(rnd))
+    for street in sorted(streets):
+        for district in rnd.sample(districts, rnd.choice((1, 1, 1, 2, 3))):
+            entries.append((district, street, random_point(rnd)))
+    return entries
+
+
+def listings(scanner, rnd, entries, n):
+    """[(district, street, expected point or None)]"""
+    known = set(street for _, street, _ in entries)
+    found = []
+    for _ in range(n):
+        district, street, point = rnd.choice([e for e in rnd.sample(entries, 3) if e[1]] or [entries[-1]])
+        if rnd.random() < UNKNOWN:
+            while street in known:
+                street = random_name(rnd)
+            point = None
+        elif rnd.random() < TYPOS and len(street) >= 8:
+            street = typo(rnd, street)
+        if rnd.random() < LATIN:
+            district, street = latin(scanner, district), latin(scanner, street)
+        street += rnd.choice([" %d" % rnd.randint(1, 150), " %d вх. Б" % rnd.randint(1, 150), " бл. %d" %
+                              rnd.randint(1, 300), ""])
+        found.append((district, street, point))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline gazetteer benchmark")
+    parser.add_argument('-n', '--listings', default=20000, type=int, help="listing addresses to look up")
+    parser.add_argument('--streets', default=3000, type=int, help="streets of the gazetteer")
+    parser.add_argument('--districts', default=40, type=int, help="districts of the gazetteer")
+    parser.add_argument('--seed', default=1, type=int, help="random seed")
+    args = parser.parse_args()
+
+    scanner = load_scanner()
+    rnd = random.Random(args.seed)
+    entries = gazetteer(rnd, args)
+    queries = listings(scanner, rnd, entries, args.listings)
+
+    workdir = tempfile.mkdtemp(prefix='aparts-bench-')
+    try:
+        path = os.path.join(workdir, 'gazetteer.csv')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write("city,district,street,lat,lon\n")
+            for district, street, point in entries:
+                f.write("София,%s,ул. %s,%.6f,%.6f\n" % ((district, street) + point) if street else
+                        "София,%s,,%.6f,%.6f\n" % ((district,) + point))
+        started = time.time()
+        places = scanner.Gazetteer(path)
+        loaded = time.time() - started
+    finally:
+        shutil.rmtree(workdir)
+
+    results = {'entries': len(entries), 'load_seconds': round(loaded, 3), 'listings': len(queries)}
+    for run in ('new', 'repeated'):
+        started = time.time()
+        points = [places.locate("София", district, street) for district, street, _ in queries]
+        elapsed = time.time() - started
+        results['%s_lookups_per_sec' % run] = round(len(queries) / elapsed)
+        results['%s_lookup_us' % run] = round(elapsed / len(queries) * 1e6, 1)
+
+    results['found'] = sum(1 for p, (_, _, expected) in zip(points, queries) if p is not None and p == expected)
+    results['wrong'] = sum(1 for p, (_, _, expected) in zip(points, queries) if p is not None and p != expected)
+    results['not_found'] = sum(1 for p in points if p is None)
+    results['unknown_streets'] = sum(1 for _, _, expected in queries if expected is None)
+    print(json.dumps({'benchmark': 'gazetteer', 'python': sys.version.split()[0], 'results': results}, indent=2,
+                     sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Price history benchmark: History.append() of made-up runs and the --query
+aggregates of the resulting columns.
+
+    python bench/bench_history.py -n 60000 --runs 100 --districts 40
+
+Every run is a day, the listings stay on the market for a random number of
+runs and are re-priced now and then. Reported: the append time, the size
+on disk and the time of every query, checked against computing them with
+plain Python over the rows.
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from common import load_scanner
+
+DAY = 86400
+# Monday
+START = 1767571200.0
+
+
+def listings(scanner, rnd, args):
+    """[(first run, last run, apartment)]"""
+    districts = ['District %d' % d for d in range(args.districts)]
+    found = []
+    for n in range(args.listings):
+        a = scanner.Apartment(n + 1, 'http://www.imot.bg/pcgi/imot.cgi?act=5&adv=hist%07d' % n)
+        a.district = rnd.choice(districts)
+        a.sqm = '%d' % rnd.randint(30, 150)
+        a.rooms = '%d' % rnd.randint(1, 4)
+        a.floor = '%d' % rnd.randint(1, 12)
+        a.price = '%d' % (int(a.sqm) * rnd.randint(8, 20))
+        a.distance = rnd.uniform(1, 15)
+        first = rnd.randrange(args.runs)
+        found.append((first, min(args.runs - 1, first + rnd.randint(3, 90)), a))
+    return found
+
+
+def expected_eur_sqm(rows, period):
+    """{(period, district): median EUR/sqm} of the last row of every listing in the period"""
+    last = {}
+    for when, url, district, price, sqm in rows:
+        day = int(when // DAY)
+        last[(day - (day + 3) % 7 if period == 'week' else day, url)] = (district, price / sqm)
+    groups = {}
+    for (day, _), (district, eur) in last.items():
+        groups.setdefault((day, district), []).append(eur)
+    medians = {}
+    for key, values in groups.items():
+        values.sort()
+        medians[key] = (values[(len(values) - 1) // 2] + values[len(values) // 2]) / 2
+    return medians
+
+
+def main():
+    parser = argparse.ArgumentParser(description="price history append and query benchmark")
+    parser.add_argument('-n', '--listings', default=60000, type=int, help="listings")
+    parser.add_argument('--runs', default=100, type=int, help="runs, a day apart")
+    parser.add_argument('--districts', default=40, type=int, help="districts")
+    parser.add_argument('--seed', default=1, type=int, help="random seed")
+    args = parser.parse_args()
+
+    scanner = load_scanner()
+    rnd = random.Random(args.seed)
+    found = listings(scanner, rnd, args)
+    workdir = tempfile.mkdtemp(prefix='aparts-bench-')
+    try:
+        history = scanner.History(workdir)
+        rows = []
+        appending = 0
+        for run in range(args.runs):
+            current = [a for first, last, a in found if first <= run <= last]
+            for a in current:
+                if rnd.random() < 0.02:
+                    a.price = '%d' % (int(a.price) * rnd.uniform(0.85, 1.05))
+            when = START + run * DAY
+            started = time.time()
+            history.append(current, when=when)
+            appending += time.time() - started
+            rows.extend((when, a.url, scanner.district_key(a.district), float(a.price), float(a.sqm))
+                        for a in current)
+        size = sum(history.size(c, t) * scanner.array(str(t)).itemsize for c, t in scanner.History.COLUMNS)
+
+        results = {'rows': history.rows, 'append_seconds': round(appending, 2),
+                   'rows_per_sec': round(history.rows / appending), 'megabytes': round(size / 1e6, 1)}
+        for query, period in (('eur_sqm', 'week'), ('eur_sqm', 'day'), ('market', None), ('drops', None)):
+            # reopened, the queries of a command line
+            started = time.time()
+            header, result = scanner.history_query(scanner.History(workdir), query, period, 20)
+            results['%s_%s_seconds' % (query, period) if period else '%s_seconds' % query] = \
+                round(time.time() - started, 3)
+            if query == 'eur_sqm':
+                expected = expected_eur_sqm(rows, period)
+                got = dict(((r[0], r[1]), float(r[3])) for r in result)
+                results['eur_sqm_%s_groups' % period] = len(result)
+                results['eur_sqm_%s_mismatches' % period] = sum(
+                    1 for (day, district), eur in expected.items()
+                    if abs(got.get((str(scanner.numpy.datetime64(day, 'D')), district), -1) - eur) > 0.5 + 1e-6)
+    finally:
+        shutil.rmtree(workdir)
+    print(json.dumps({'benchmark': 'history', 'python': sys.version.split()[0], 'results': results}, indent=2,
+                     sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Lazy geocoding benchmark: the -t top of the rankings with all the apartments
+geocoded vs with geocode_top() geocoding only those that can make the top,
+against the stub geocoder of stub_server.py, empty geocoding caches.
+
+    python bench/bench_lazy.py -n 5000 --top 10 20 50
+
+Reported for every top size: the geocoding requests and time of both and
+whether the tops (apartments and scores) are the same.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import logging
+import shutil
+import argparse
+import tempfile
+
+from common import CONFIG, load_scanner, listing_urls
+from bench_parse import pages
+from stub_server import StubServer
+
+
+def run(scanner, server, parsed, profiles, top, lazy, args):
+    workdir = tempfile.mkdtemp(prefix='aparts-bench-')
+    try:
+        scanner.GEOCODES = scanner.GeoCache(os.path.join(workdir, 'geocodes.sqlite'))
+        scanner.DISTANCES.clear()
+        apartments = []
+        for n, (url, fields) in enumerate(parsed):
+            a = scanner.Apartment(n + 1, url)
+            a.update(fields)
+            apartments.append(a)
+        geolocator = scanner.geocoders.Nominatim(user_agent="aparts-bench", domain=server.proxy.split('//')[1],
+                                                 scheme='http')
+        geocoder = scanner.GeocodeScheduler(geolocator, args.geocode_rate)
+
+        requests = len(server.stats.geocodes)
+        started = time.time()
+        location = geocoder.geocode('InterContinental Sofia')
+        if lazy:
+            scanner.geocode_top(apartments, profiles, top, geocoder, location, args.max_distance)
+        else:
+            for a in apartments:
+                geocoder.submit(a)
+            geocoder.join()
+            for a in apartments:
+                a.initDistance(location)
+        ranked = list(scanner.rank(apartments, profiles, top))
+        elapsed = time.time() - started
+    finally:
+        shutil.rmtree(workdir)
+    tops = [[(a.url, round(float(score), 6)) for score, a in ranking] for _, ranking in ranked]
+    return {'geocoding_requests': len(server.stats.geocodes) - requests, 'seconds': round(elapsed, 2)}, tops
+
+
+def main():
+    parser = argparse.ArgumentParser(description="lazy geocoding of the top apartments vs geocoding all")
+    parser.add_argument('-n', '--listings', default=5000, type=int, help="apartments to rank")
+    parser.add_argument('--top', default=[10, 20, 50], type=int, nargs='+', help="top sizes")
+    parser.add_argument('--geocode-rate', default=1000.0, type=float, help="geocoding requests per second")
+    parser.add_argument('--max-distance', default=50.0, type=float, help="geocode_top() max distance, km")
+    args = parser.parse_args()
+
+    # no warnings about the addresses the stub geocoder can't find
+    logging.basicConfig(level=logging.ERROR)
+    scanner = load_scanner()
+    profiles = scanner.Config([CONFIG]).profiles
+    parsed = []
+    for url, data in pages(listing_urls(args.listings)):
+        a = scanner.Apartment(0, url)
+        a.scan(data)
+        parsed.append((url, a.fields()))
+
+    server = StubServer().start()
+    results = {'benchmark': 'lazy', 'python': sys.version.split()[0], 'listings': args.listings}
+    try:
+        for top in args.top:
+            eager, expected = run(scanner, server, parsed, profiles, top, False, args)
+            lazy, found = run(scanner, server, parsed, profiles, top, True, args)
+            results['top_%d' % top] = {'all': eager, 'lazy': lazy, 'same_top': found == expected}
+    finally:
+        server.shutdown()
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory per parsed listing: the slotted Apartment records vs the same fields
+kept in a per-object __dict__ with a private copy of every string, the way
+Apartment records were held before.
+
+    python bench/bench_memory.py -n 3000
+
+Sizes are the sums of sys.getsizeof() over every object reachable from the
+records, objects shared between the records (shared strings, small ints)
+are counted once.
+"""
+
+from __future__ import print_function
+
+import sys
+import json
+import argparse
+
+from common import load_scanner, listing_urls
+from bench_parse import pages
+
+
+class DictRecord(object):
+    """Apartment fields in the instance __dict__, strings not shared"""
+
+    def __init__(self, a):
+        for attr in a.__slots__:
+            v = getattr(a, attr)
+            if isinstance(v, type(u'')) and len(v) > 1:
+                v = (v + u' ')[:-1]
+            setattr(self, attr, v)
+        self.images_set = set(self.images_list)
+
+
+def deep_size(objects):
+    seen = set()
+    stack = list(objects)
+    total = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        else:
+            if hasattr(o, '__dict__'):
+                stack.append(o.__dict__)
+            for attr in getattr(type(o), '__slots__', ()):
+                if hasattr(o, attr):
+                    stack.append(getattr(o, attr))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="memory per listing benchmark")
+    parser.add_argument('-n', '--listings', default=3000, type=int, help="number of listings")
+    args = parser.parse_args()
+
+    scanner = load_scanner()
+    apartments = []
+    for n, (url, data) in enumerate(pages(listing_urls(args.listings)), 1):
+        a = scanner.Apartment(n, url)
+        a.scan(data)
+        apartments.append(a)
+
+    records = deep_size(apartments)
+    legacy = deep_size([DictRecord(a) for a in apartments])
+    print(json.dumps({'benchmark': 'memory', 'listings': len(apartments),
+                      'bytes_per_listing': {'slots': records // len(apartments),
+                                            'dict': legacy // len(apartments)},
+                      'ratio': round(float(legacy) / records, 2)}, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parse throughput benchmark and extraction check on the page corpus.
+
+    python bench/bench_parse.py -n 300           # time Apartment.scan() and the page decoding per site
+    python bench/bench_parse.py --check          # compare extracted fields with corpus/expected.json
+    python bench/bench_parse.py --save           # regenerate corpus/expected.json
+    python bench/bench_parse.py --parse-jobs 1 4 16  # pages/sec of the Parser processes
+
+The "legacy" numbers come from applying all the RULES one by one with
+Apartment.parse() on every page, the way scan() did before the rules were
+compiled and dispatched by site. The "decode" numbers compare decoding every
+page at once (decode_page()) with converting it line by line from UTF-8 to
+cp1251, the way scan() did before the rules were in Unicode.
+
+--parse-jobs times decoding and parsing the pages of all the sites with
+Parser and every number of processes, and checks that the fields are those
+of the serial Apartment.scanPage().
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import multiprocessing
+
+from common import load_scanner, listing_urls, LISTING_URLS
+from stub_server import render_listing, CORPUS_DIR
+
+EXPECTED = os.path.join(CORPUS_DIR, 'expected.json')
+CHECK_LISTINGS = 30
+
+FIELDS = ('sqm', 'rooms', 'bedrooms', 'elevator', 'internet', 'luxe', 'garage', 'parkslot', 'park', 'garden',
+          'district', 'street', 'street_full', 'subway', 'city', 'price', 'price_wo_vat', 'floor', 'floor_max',
+          'furniture', 'cozy', 'pool', 'calm', 'fireplace', 'unique', 'luxury', 'bath', 'prestigious',
+          'renovated', 'gym', 'restaurants', 'location', 'mall', 'transport', 'leisure', 'balcony', 'view',
+          'images_list')
+
+
+def pages(urls):
+    """[(url, decoded lines)] of the listing pages"""
+    corpus = []
+    for url in urls:
+        body, charset = render_listing(url)
+        corpus.append((url, body.decode(charset).split(u'\n')))
+    return corpus
+
+
+def per_line_decode(body):
+    """The page lines converted one by one from UTF-8 to cp1251, cp1251 lines kept as they are"""
+    lines = []
+    for line in body.split(b'\n'):
+        try:
+            lines.append(line.decode('utf-8').encode('cp1251', 'ignore'))
+        except UnicodeDecodeError:
+            lines.append(line)
+    return lines
+
+
+def timed_decode(scanner, urls):
+    bodies = [(render_listing(url), scanner.site_of(url)) for url in urls]
+    results = {}
+    for name, decode in (('document', lambda body, charset, site: scanner.page_lines(body, charset, site)),
+                         ('per_line', lambda body, charset, site: per_line_decode(body))):
+        started = time.time()
+        for (body, charset), site in bodies:
+            decode(body, charset, site)
+        elapsed = time.time() - started
+        results[name] = {'seconds': round(elapsed, 4), 'pages_per_sec': round(len(bodies) / elapsed, 1)}
+    results['speedup'] = round(results['per_line']['seconds'] / results['document']['seconds'], 1)
+    return results
+
+
+def legacy_scan(scanner, a, data):
+    """Apartment.scan() with every rule applied through Apartment.parse()"""
+    site = scanner.site_of(a.url)
+    engine = site.engine
+    site.engine = LegacyEngine(scanner.RULES)
+    try:
+        a.scan(data)
+    finally:
+        site.engine = engine
+
+
+class LegacyEngine:
+    def __init__(self, rules):
+        self.rules = rules
+
+    def match(self, a, line):
+        for rule in self.rules:
+            a.parse(rule[0], rule[1], line, rule[2] if len(rule) > 2 else None, rule[3] if len(rule) > 3 else False)
+        return line
+
+
+def fields(a):
+    return dict((f, getattr(a, f)) for f in FIELDS)
+
+
+def to_text(v):
+    if isinstance(v, bytes):
+        return v.decode('cp1251')
+    if isinstance(v, list):
+        return [to_text(i) for i in v]
+    if isinstance(v, dict):
+        return dict((k, to_text(i)) for k, i in v.items())
+    return v
+
+
+def timed(scanner, corpus, scan):
+    started = time.time()
+    lines = 0
+    for url, data in corpus:
+        scan(scanner.Apartment(0, url), data)
+        lines += len(data)
+    elapsed = time.time() - started
+    return {'pages': len(corpus), 'lines': lines, 'seconds': round(elapsed, 4),
+            'pages_per_sec': round(len(corpus) / elapsed, 1), 'lines_per_sec': round(lines / elapsed)}
+
+
+def main_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def timed_parser(scanner, corpus, jobs, expected, serial_seconds):
+    parser = scanner.Parser(jobs)
+    try:
+        cpu = main_cpu_seconds()
+        started = time.time()
+        parsed = [fields(a) for a, _ in parser.imap((scanner.Apartment(0, url), page) for url, page in corpus)]
+        elapsed = time.time() - started
+        cpu = main_cpu_seconds() - cpu
+    finally:
+        parser.close()
+    # the main process feeds the parser processes, it keeps up to max_processes of them busy
+    return {'pages': len(corpus), 'seconds': round(elapsed, 4), 'pages_per_sec': round(len(corpus) / elapsed, 1),
+            'main_cpu_seconds': round(cpu, 4), 'max_processes': round(serial_seconds / cpu, 1),
+            'identical': parsed == expected}
+
+
+def bench_parser(scanner, args):
+    """Apartment.scanPage() of the (page bytes, charset) in the main process vs Parser processes"""
+    corpus = [(url, render_listing(url)) for url in listing_urls(args.listings * len(LISTING_URLS))]
+    started = time.time()
+    expected = []
+    for url, page in corpus:
+        a = scanner.Apartment(0, url)
+        a.scanPage(page)
+        expected.append(fields(a))
+    elapsed = time.time() - started
+    results = {'cpus': multiprocessing.cpu_count(),
+               'serial': {'pages': len(corpus), 'seconds': round(elapsed, 4),
+                          'pages_per_sec': round(len(corpus) / elapsed, 1)}}
+    for jobs in args.parse_jobs:
+        results['parse_jobs_%d' % jobs] = timed_parser(scanner, corpus, jobs, expected, elapsed)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="parse benchmark")
+    parser.add_argument('-n', '--listings', default=300, type=int, help="number of pages per site")
+    parser.add_argument('--check', action='store_true', help="check extracted fields against the saved corpus")
+    parser.add_argument('--save', action='store_true', help="save extracted fields as the expected corpus output")
+    parser.add_argument('--parse-jobs', nargs='+', type=int, help="time Parser with these numbers of processes")
+    args = parser.parse_args()
+
+    scanner = load_scanner()
+
+    if args.parse_jobs:
+        print(json.dumps({'benchmark': 'parser', 'results': bench_parser(scanner, args)}, indent=2, sort_keys=True))
+        return
+
+    if args.check or args.save:
+        corpus = pages(listing_urls(CHECK_LISTINGS))
+        got = {}
+        for url, data in corpus:
+            a = scanner.Apartment(0, url)
+            a.scan(data)
+            got[url] = to_text(fields(a))
+        if args.save:
+            with open(EXPECTED, 'w') as f:
+                json.dump(got, f, indent=1, sort_keys=True)
+            return
+        with open(EXPECTED) as f:
+            expected = json.load(f)
+        diff = sorted(url for url in expected if expected[url] != got.get(url))
+        print(json.dumps({'check': 'parse', 'pages': len(expected), 'mismatches': diff}, indent=2))
+        sys.exit(1 if diff else 0)
+
+    results = {}
+    for template in LISTING_URLS:
+        site = template.split('/')[2]
+        urls = listing_urls(args.listings, sites=(template,))
+        corpus = pages(urls)
+        results[site] = {'engine': timed(scanner, corpus, lambda a, data: a.scan(data)),
+                         'legacy': timed(scanner, corpus, lambda a, data: legacy_scan(scanner, a, data)),
+                         'decode': timed_decode(scanner, urls)}
+        results[site]['speedup'] = round(results[site]['legacy']['seconds'] / results[site]['engine']['seconds'], 1)
+    print(json.dumps({'benchmark': 'parse', 'results': results}, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Points of interest scoring benchmark: Pois.measure() of made-up apartments
+and points of interest scattered over Sofia, checked against measuring a
+sample of the apartments against all the points.
+
+    python bench/bench_poi.py -n 50000 --pois metro=40 park=1000 school=3000 office=5
+
+No geocoding: the coordinates of the apartments are put into the geocoding
+cache of a temporary directory.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from common import load_scanner
+
+# Sofia
+SOUTH, NORTH, WEST, EAST = 42.62, 42.76, 23.22, 23.43
+SAMPLE = 300
+
+
+def random_point(rnd):
+    return rnd.uniform(SOUTH, NORTH), rnd.uniform(WEST, EAST)
+
+
+def brute_force(scanner, point, pois):
+    """{feature: value} of the point measured against all the points of interest"""
+    numpy = scanner.numpy
+    lat, lon = numpy.radians(point)
+    features = {}
+    for kind, points in pois.points.items():
+        km = scanner.haversine_km(lat, lon, points[:, 0], points[:, 1])
+        features['%s_km' % kind] = float(km.min())
+        features['%s_500m' % kind] = float((km <= scanner.POI_RADIUS_KM).sum())
+    return features
+
+
+def main():
+    parser = argparse.ArgumentParser(description="points of interest scoring benchmark")
+    parser.add_argument('-n', '--apartments', default=50000, type=int, help="apartments to measure")
+    parser.add_argument('--pois', default=['metro=40', 'park=1000', 'school=3000', 'office=5'], nargs='+',
+                        metavar='KIND=N', help="points of interest of every kind")
+    parser.add_argument('--seed', default=1, type=int, help="random seed")
+    args = parser.parse_args()
+
+    scanner = load_scanner()
+    rnd = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='aparts-bench-')
+    try:
+        path = os.path.join(workdir, 'pois.csv')
+        with open(path, 'w') as f:
+            f.write('kind,lat,lon,name\n')
+            for kind, n in (p.split('=') for p in args.pois):
+                for i in range(int(n)):
+                    f.write('%s,%.6f,%.6f,%s %d\n' % ((kind,) + random_point(rnd) + (kind, i)))
+
+        scanner.GEOCODES = scanner.GeoCache(os.path.join(workdir, 'geocodes.sqlite'))
+        apartments = []
+        for n in range(args.apartments):
+            a = scanner.Apartment(n + 1, 'http://www.imot.bg/pcgi/imot.cgi?act=5&adv=poi%06d' % n)
+            a.street = 'street %d' % n
+            scanner.GEOCODES.points[a.getAddresses()[0]] = random_point(rnd)
+            apartments.append(a)
+
+        started = time.time()
+        pois = scanner.Pois(path)
+        loaded = time.time() - started
+        started = time.time()
+        pois.measure(apartments)
+        elapsed = time.time() - started
+
+        errors = 0
+        for a in rnd.sample(apartments, min(SAMPLE, len(apartments))):
+            expected = brute_force(scanner, a.getPoint(), pois)
+            errors += any(abs(a.poi[f] - expected[f]) > 1e-9 for f in expected)
+    finally:
+        shutil.rmtree(workdir)
+
+    results = {'apartments': len(apartments), 'pois': sum(len(p) for p in pois.points.values()),
+               'features': list(pois.features), 'load_seconds': round(loaded, 4),
+               'measure_seconds': round(elapsed, 3), 'apartments_per_sec': round(len(apartments) / elapsed),
+               'checked': min(SAMPLE, len(apartments)), 'mismatches': errors}
+    print(json.dumps({'benchmark': 'poi', 'python': sys.version.split()[0], 'results': results}, indent=2,
+                     sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Watch mode benchmark: a scanner run every --interval minutes (as from cron)
+vs a single --watch scanner polling at the same interval, for --seconds
+against the local stub server publishing new listings at --rate per minute
+on top of the imot.bg searches (the stub can't proxy the https listings of
+the other websites' searches).
+
+    python bench/bench_watch.py --seconds 60 --interval 0.05 --rate 30
+
+Both start with empty caches. Reported for every mode: the scanner runs,
+their CPU time, the requests to every website, the new listings published
+and the listings of the final report.
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import signal
+import resource
+import argparse
+import tempfile
+import subprocess
+
+from common import SCANNER, CONFIG
+from stub_server import StubServer
+
+SEARCH_URL = 'http://www.imot.bg/pcgi/imot.cgi?act=3&slink=watch%02d&f1=1'
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(mode, args):
+    server = StubServer(delay=args.delay, new_listings={'imot.bg': args.rate}).start()
+    workdir = tempfile.mkdtemp(prefix='aparts-bench-')
+    try:
+        searches = os.path.join(workdir, 'searches.txt')
+        with open(searches, 'w') as f:
+            f.write('\n'.join(SEARCH_URL % i for i in range(args.searches)) + '\n')
+        report = os.path.join(workdir, 'report.html')
+        env = dict(os.environ, http_proxy=server.proxy, no_proxy='127.0.0.1', TMPDIR=workdir)
+        cmd = [sys.executable, SCANNER, '-c', CONFIG, '-p', searches, '--depth', str(args.depth), '-w', report,
+               '-d', 'InterContinental Sofia', '--geocoder', server.proxy, '--geocode-rate', '1000']
+
+        cpu = cpu_seconds()
+        started = time.time()
+        runs = 0
+        if mode == 'watch':
+            process = subprocess.Popen(cmd + ['--watch', str(args.interval)], env=env)
+            time.sleep(args.seconds)
+            process.send_signal(signal.SIGINT)
+            process.wait()
+            runs = 1
+        else:
+            while time.time() - started < args.seconds:
+                subprocess.check_call(cmd, env=env)
+                runs += 1
+                time.sleep(max(0.0, started + runs * args.interval * 60 - time.time()))
+        elapsed = time.time() - started
+
+        with open(report, 'rb') as f:
+            listings = len(re.findall(b"<tr class='grid'", f.read()))
+        stats = json.loads(server.stats.to_json())
+        return {'runs': runs, 'seconds': round(elapsed, 1), 'cpu_seconds': round(cpu_seconds() - cpu, 2),
+                'requests': sum(stats['requests'].values()), 'report_listings': listings,
+                'published': args.searches * int(elapsed * args.rate / 60)}
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="scanner runs from cron vs --watch")
+    parser.add_argument('--seconds', default=60, type=float, help="duration of every mode")
+    parser.add_argument('--interval', default=0.05, type=float, help="minutes between the runs / --watch minutes")
+    parser.add_argument('--rate', default=30, type=float, help="new listings per minute on top of every search")
+    parser.add_argument('--searches', default=4, type=int, help="searches to watch")
+    parser.add_argument('--depth', default=5, type=int, help="search pages --depth")
+    parser.add_argument('--delay', default=0.01, type=float, help="stub server response delay, seconds")
+    args = parser.parse_args()
+
+    results = {'benchmark': 'watch', 'python': sys.version.split()[0], 'interval_minutes': args.interval,
+               'rate': args.rate}
+    for mode in ('cron', 'watch'):
+        results[mode] = run(mode, args)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+"""Helpers shared by the benchmarks"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCANNER = os.path.join(ROOT, 'bg-apartments-scan.py')
+CONFIG = os.path.join(ROOT, 'config.txt')
+
+LISTING_URLS = ('http://www.imot.bg/pcgi/imot.cgi?act=5&adv=bench%05d&slink=stub&f1=1',
+                'http://ues.bg/en/offers/1%05d-apartment-for-rent',
+                'http://www.luximmo.com/bulgaria/region-sofia/sofia/luxury-property-%05d-apartment-for-rent.html')
+
+
+def listing_urls(n, sites=LISTING_URLS):
+    return [sites[i % len(sites)] % i for i in range(n)]
+
+
+def load_scanner():
+    """Import bg-apartments-scan.py as a module"""
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('scanner', SCANNER)
+        module = importlib.util.module_from_spec(spec)
+        # importable by name, the parser processes unpickle its functions
+        sys.modules['scanner'] = module
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        import imp
+        return imp.load_source('scanner', SCANNER)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local stub of imot.bg, ues.bg and luximmo.com for offline benchmarks.
+
+The server works as an HTTP proxy: point http_proxy at it and request the
+real site URLs, it answers every listing page from the templates in
+bench/corpus/, filled with values derived from the URL. Each response is
+delayed by --delay seconds to emulate network latency.
+
+    python bench/stub_server.py --port 8765 --delay 0.2 &
+    http_proxy=http://127.0.0.1:8765 python bg-apartments-scan.py -l links.txt
+
+Search pages (imot.bg act=3, ues.bg loadOffers, luximmo.com /search) come
+from the bench/corpus/*.search.html templates with LINKS_PER_PAGE links to
+made-up listings, searches end after SEARCH_PAGES pages. With --new-listings
+new listings keep appearing on top of the first page of the searches.
+
+Listing pages carry an ETag and conditional requests with a matching
+If-None-Match get 304 Not Modified. GET /__stats returns request counts,
+304 counts, bytes sent and the peak number of parallel requests for every
+host and the number of client connections.
+
+Connections are kept alive (HTTP/1.1) unless the client asks to close them,
+pages are gzip-compressed for the clients accepting it. --connect-delay
+emulates the TCP/TLS handshake of every new connection.
+
+It is also a stub Nominatim geocoder (GET /search?q=...&format=json) with
+made-up coordinates around Sofia, one address in four can't be found:
+
+    python bg-apartments-scan.py -d 'InterContinental Sofia' --geocoder http://127.0.0.1:8765 ...
+
+With --quota-every N every Nth geocoding request is rejected with 429.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import gzip
+import random
+import socket
+import hashlib
+import argparse
+import threading
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+    from io import BytesIO
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from cStringIO import StringIO as BytesIO
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+# host -> (template, charset, district names, street names)
+SITES = {
+    'imot.bg': ('imot.bg.html', 'cp1251',
+                [u'Лозенец', u'Изток', u'Иван Вазов', u'Център', u'Младост', u'Докторски паметник'],
+                [u'Червена стена', u'Кричим', u'Милин камък', u'Фритьоф Нансен', u'Златовръх']),
+    'ues.bg': ('ues.bg.html', 'utf-8',
+               [u'Lozenets', u'Iztok', u'Ivan Vazov', u'Center', u'Mladost'],
+               [u'Cherni vrah', u'Krichim', u'Zlatovrah']),
+    'luximmo.com': ('luximmo.com.html', 'utf-8',
+                    [u'Lozenets', u'Iztok', u'Ivan Vazov', u'Center', u'Boyana'],
+                    [u'Cherni vrah', u'Krichim', u'Zlatovrah']),
+}
+
+LINKS_PER_PAGE = 20
+
+# related listings and size of the inline script after the contacts of a listing page
+RELATED = 40
+SCRIPT_SIZE = 30000
+
+# every search has this many result pages, the pages after the last one have no links
+SEARCH_PAGES = 5
+
+
+def site_of(host):
+    for name in SITES:
+        if host == name or host.endswith('.' + name):
+            return name
+    return None
+
+
+def listing_values(url, site):
+    _, _, districts, streets = SITES[site]
+    rnd = random.Random(int(hashlib.md5(url.encode('utf-8')).hexdigest(), 16))
+
+    # random() is the same in Python 2 and 3, randint() and choice() aren't
+    def randint(low, high):
+        return low + int(rnd.random() * (high - low + 1))
+
+    def choice(items):
+        return items[int(rnd.random() * len(items))]
+
+    rooms = randint(1, 5)
+    floor_max = randint(2, 16)
+    return {
+        'adv': hashlib.md5(url.encode('utf-8')).hexdigest()[:12],
+        'rooms': rooms,
+        'bedrooms': max(rooms - 1, 1),
+        'sqm': randint(35, 250),
+        'price': '%d %03d' % divmod(randint(1000, 4000), 1000) if rnd.random() < 0.5 else
+                 str(randint(400, 999)),
+        'floor': randint(1, floor_max),
+        'floor_max': floor_max,
+        'district': choice(districts),
+        'street': choice(streets),
+        'house': randint(1, 120),
+        'garage_bg': choice([u'гараж</div>', u'паркомясто</div>', u'климатик</div>']),
+        'title': choice([u'Furnished apartment with parking place',
+                         u'Bright apartment near the park',
+                         u'Luxury penthouse with a panoramic view']),
+    }
+
+
+def related_listings(url):
+    """The tail of a listing page after the contacts: related listings and scripts, most of a real page"""
+    seed = hashlib.md5(url.encode('utf-8')).hexdigest()
+    related = [u'<div class="related"><a href="/offer/%s%02d"><img src="/photos/%s%02d.jpg">'
+               u'<span>Apartment for rent</span></a></div>' % (seed[:8], i, seed[:8], i) for i in range(RELATED)]
+    script = u'<script>var tracking = "%s";</script>' % (seed * (SCRIPT_SIZE // len(seed)))
+    return u'\n'.join(related + [script]) + u'\n'
+
+
+def render_listing(url, site=None, values=None):
+    """Listing page bytes for the given URL (or with the given listing_values()) and its charset"""
+    site = site or site_of(urlparse(url).netloc.lower())
+    template, charset, _, _ = SITES[site]
+    with open(os.path.join(CORPUS_DIR, template), 'rb') as f:
+        body = f.read().decode(charset) % (values or listing_values(url, site))
+    end = body.rindex(u'</body>')
+    body = body[:end] + related_listings(url) + body[end:]
+    return body.encode(charset), charset
+
+
+def page_number(url):
+    query = parse_qs(urlparse(url).query)
+    return int((query.get('f1') or query.get('page') or ['1'])[0] or 1)
+
+
+def search_page(url, site, new=0):
+    """Search results page bytes with LINKS_PER_PAGE apartment links, the first page starts with the new newest ones"""
+    _, charset, _, _ = SITES[site]
+    seed = hashlib.md5(url.encode('utf-8')).hexdigest()
+    page = page_number(url)
+    advs = []
+    if page == 1:
+        for j in range(new - 1, max(new - LINKS_PER_PAGE, 0) - 1, -1):
+            advs.append(hashlib.md5(('%s#%d' % (url, j)).encode('utf-8')).hexdigest()[:12])
+    advs += ['%s%02d' % (seed[:10], i) for i in range(LINKS_PER_PAGE if page <= SEARCH_PAGES else 0)]
+    links = []
+    for adv in advs:
+        if site == 'imot.bg':
+            links.append(u'<tr><td><a href="//www.imot.bg/pcgi/imot.cgi?act=5&adv=%s&slink=stub&f1=1" '
+                         u'class="photoLink"><img src="//imotstatic1.focus.bg/imot/photosimotbg/1/000/small/%s.jpg">'
+                         u'</a></td></tr>' % (adv, adv))
+        elif site == 'ues.bg':
+            links.append(u'<a href="https://ues.bg/en/offers/1%s-apartment-for-rent">' % adv[-6:])
+        else:
+            links.append(u'<a class="offer-link" href="https://www.luximmo.com/bulgaria/region-sofia/sofia/'
+                         u'luxury-property-%s-apartment-for-rent-in-sofia.html">' % adv[-6:])
+    with open(os.path.join(CORPUS_DIR, '%s.search.html' % site), 'rb') as f:
+        body = f.read().decode(charset) % {'links': u'\n'.join(links), 'page': page}
+    return body.encode(charset)
+
+
+def geocode(query):
+    """Nominatim-like answer for the query"""
+    h = int(hashlib.md5(query.encode('utf-8')).hexdigest(), 16)
+    if h % 4 == 0:
+        return []
+    return [{'lat': '%.6f' % (42.62 + (h % 1000) / 10000.0), 'lon': '%.6f' % (23.26 + (h // 1000 % 1400) / 10000.0),
+             'display_name': query, 'place_id': h % 100000000, 'importance': 0.5}]
+
+
+def is_search_page(url):
+    return 'act=3' in url or 'loadOffers' in url or '/search' in url
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.active = {}
+        self.peak = {}
+        self.counters = {}
+        self.sent = {}
+        self.connections = 0
+        self.geocodes = []
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+
+    def add_sent(self, host, size):
+        with self.lock:
+            self.sent[host] = self.sent.get(host, 0) + size
+
+    def enter(self, host):
+        with self.lock:
+            self.requests[host] = self.requests.get(host, 0) + 1
+            self.active[host] = self.active.get(host, 0) + 1
+            self.peak[host] = max(self.peak.get(host, 0), self.active[host])
+
+    def count(self, counter, host):
+        with self.lock:
+            hosts = self.counters.setdefault(counter, {})
+            hosts[host] = hosts.get(host, 0) + 1
+
+    def geocoded(self):
+        """Count a geocoding request, returns the number of geocoding requests so far"""
+        with self.lock:
+            self.geocodes.append(time.time())
+            return len(self.geocodes)
+
+    def max_rate(self):
+        """Max number of geocoding requests in a second"""
+        best = 0
+        start = 0
+        for end in range(len(self.geocodes)):
+            while self.geocodes[end] - self.geocodes[start] >= 1.0:
+                start += 1
+            best = max(best, end - start + 1)
+        return best
+
+    def leave(self, host):
+        with self.lock:
+            self.active[host] -= 1
+
+    def to_json(self):
+        with self.lock:
+            stats = {'requests': self.requests, 'peak_parallel': self.peak, 'bytes_sent': self.sent,
+                     'connections': self.connections,
+                     'geocoder': {'requests': len(self.geocodes), 'max_per_second': self.max_rate()}}
+            stats.update(self.counters)
+            return json.dumps(stats, sort_keys=True)
+
+
+def gzipped(body):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(body)
+    return buf.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # the headers and the body are separate writes, don't hold the body back on a kept-alive connection
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.stats.connected()
+        time.sleep(self.server.connect_delay)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def reply(self, code, body, content_type, etag=None, host=None):
+        compress = body and 'gzip' in (self.headers.get('Accept-Encoding') or '')
+        if compress:
+            body = gzipped(body)
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if host:
+            self.server.stats.add_sent(host, len(body))
+
+    def do_GET(self):
+        if self.path.startswith('/__stats'):
+            return self.reply(200, self.server.stats.to_json().encode('utf-8'), 'application/json')
+        if self.path.startswith('/search'):
+            return self.geocoder()
+
+        url = self.path if self.path.startswith('http') else 'http://%s%s' % (self.headers.get('Host', ''), self.path)
+        host = urlparse(url).netloc.lower()
+        site = site_of(host)
+        if not site:
+            return self.reply(404, b'unknown host', 'text/plain')
+
+        self.server.stats.enter(host)
+        try:
+            time.sleep(self.server.delay)
+            if is_search_page(url):
+                charset = SITES[site][1]
+                new = int((time.time() - self.server.started) * self.server.new_listings.get(site, 0) / 60)
+                body = search_page(url, site, new)
+            else:
+                body, charset = render_listing(url, site)
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.server.stats.count('not_modified', host)
+                return self.reply(304, b'', 'text/html; charset=%s' % charset, etag, host)
+            self.reply(200, body, 'text/html; charset=%s' % charset, etag, host)
+        finally:
+            self.server.stats.leave(host)
+
+    def geocoder(self):
+        n = self.server.stats.geocoded()
+        if self.server.quota_every and n % self.server.quota_every == 0:
+            self.server.stats.count('quota_exceeded', 'geocoder')
+            return self.reply(429, b'{"error": "rate limited"}', 'application/json')
+        query = parse_qs(urlparse(self.path).query).get('q', [''])[0]
+        if not isinstance(query, type(u'')):
+            query = query.decode('utf-8')
+        self.reply(200, json.dumps(geocode(query)).encode('utf-8'), 'application/json')
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, delay=0.0, verbose=False, quota_every=0, connect_delay=0.0, new_listings=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.started = time.time()
+        self.new_listings = new_listings or {}
+        self.delay = delay
+        self.connect_delay = connect_delay
+        self.quota_every = quota_every
+        self.verbose = verbose
+        self.stats = Stats()
+
+    def handle_error(self, request, client_address):
+        # the scanner stops reading a listing page after its stop word
+        if not isinstance(sys.exc_info()[1], IOError):
+            HTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def proxy(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description="imot.bg/ues.bg/luximmo.com stub HTTP proxy")
+    parser.add_argument('--port', default=8765, type=int, help="port to listen on")
+    parser.add_argument('--delay', default=0.1, type=float, help="response delay, seconds")
+    parser.add_argument('--connect-delay', default=0.0, type=float, help="new connection delay, seconds")
+    parser.add_argument('--quota-every', default=0, type=int, help="reject every Nth geocoding request with 429")
+    parser.add_argument('--new-listings', default=[], action='append', metavar='SITE=RATE',
+                        help="new listings per minute on the first search page of the site, e.g. imot.bg=2")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log every request")
+    args = parser.parse_args()
+
+    new_listings = dict((site, float(rate)) for site, rate in (a.split('=') for a in args.new_listings))
+    server = StubServer(args.port, args.delay, args.verbose, args.quota_every, args.connect_delay, new_listings)
+    print("stub server listening on %s" % server.proxy, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
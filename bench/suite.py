@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark suite: times every stage of the scanner against the page
+corpus and the local stub server / geocoder, prints the results as JSON.
+
+    python bench/suite.py                        # all the stages
+    python bench/suite.py -o before.json         # ... saved to a file
+    python bench/suite.py --baseline before.json # ... compared with a previous run
+
+Stages:
+    parse       Apartment.scan() pages/sec for every site, best of --repeat runs
+    links       find_links() links/sec crawling the stub search pages
+    score       rank() (NumPy) and calcScore() apartments/sec
+    end_to_end  main() pages/sec, cold caches and a warm rerun
+
+--baseline adds the ratio of every */sec figure to the baseline one
+(above 1 is faster) to the results.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+from common import SCANNER, CONFIG, LISTING_URLS, load_scanner, listing_urls
+from stub_server import StubServer
+from bench_parse import pages, timed
+
+SEARCH_URL = 'http://www.imot.bg/pcgi/imot.cgi?act=3&slink=bench%02d&f1=1'
+
+
+def search_urls(n):
+    return [SEARCH_URL % i for i in range(n)]
+
+
+def bench_parse(scanner, args):
+    results = {}
+    for template in LISTING_URLS:
+        corpus = pages(listing_urls(args.listings, sites=(template,)))
+        runs = [timed(scanner, corpus, lambda a, data: a.scan(data)) for _ in range(args.repeat)]
+        results[template.split('/')[2]] = min(runs, key=lambda r: r['seconds'])
+    return results
+
+
+def bench_links(scanner, server, args):
+    workdir = tempfile.mkdtemp(prefix='aparts-bench-')
+    try:
+        searches = os.path.join(workdir, 'searches.txt')
+        with open(searches, 'w') as f:
+            f.write('\n'.join(search_urls(args.searches)) + '\n')
+        options = argparse.Namespace(links=None, pages=searches, head=None, depth=args.depth, max_listings=None,
+                                     jobs=args.jobs)
+        os.environ['http_proxy'] = server.proxy
+        started = time.time()
+        links = list(scanner.find_links(options, scanner.HostLimits(args.jobs)))
+        elapsed = time.time() - started
+        scanner.HTTP.close()
+    finally:
+        shutil.rmtree(workdir)
+    return {'searches': args.searches, 'depth': args.depth, 'links': len(links), 'seconds': round(elapsed, 4),
+            'links_per_sec': round(len(links) / elapsed, 1)}
+
+
+def bench_score(scanner, args):
+    corpus = pages(listing_urls(30))
+    apartments = []
+    for n in range(args.apartments):
+        url, data = corpus[n % len(corpus)]
+        a = scanner.Apartment(n + 1, url)
+        a.scan(data)
+        apartments.append(a)
+    weights = scanner.Config([CONFIG]).weights
+
+    results = {'apartments': len(apartments)}
+    if scanner.numpy is not None:
+        started = time.time()
+        list(scanner.rank(apartments, {'default': weights}))
+        elapsed = time.time() - started
+        results['rank'] = {'seconds': round(elapsed, 4), 'apartments_per_sec': round(len(apartments) / elapsed)}
+
+    started = time.time()
+    for a in apartments:
+        a.calcScore(weights)
+    elapsed = time.time() - started
+    results['calcScore'] = {'seconds': round(elapsed, 4), 'apartments_per_sec': round(len(apartments) / elapsed)}
+    return results
+
+
+def bench_end_to_end(server, args):
+    workdir = tempfile.mkdtemp(prefix='aparts-bench-')
+    try:
+        links = os.path.join(workdir, 'links.txt')
+        with open(links, 'w') as f:
+            f.write('\n'.join(listing_urls(args.listings)) + '\n')
+        searches = os.path.join(workdir, 'searches.txt')
+        with open(searches, 'w') as f:
+            f.write('\n'.join(search_urls(args.searches)) + '\n')
+
+        env = dict(os.environ, http_proxy=server.proxy, no_proxy='127.0.0.1', TMPDIR=workdir)
+        cmd = [sys.executable, SCANNER, '-c', CONFIG, '-l', links, '-p', searches, '--depth', str(args.depth),
+               '-j', str(args.jobs), '--host-jobs', str(args.jobs), '-w', os.path.join(workdir, 'report.html'),
+               '-d', 'InterContinental Sofia', '--geocoder', server.proxy, '--geocode-rate', '1000']
+
+        results = {}
+        for run in ('cold', 'warm'):
+            requests = sum(server.stats.requests.values())
+            started = time.time()
+            subprocess.check_call(cmd, env=env)
+            elapsed = time.time() - started
+            requests = sum(server.stats.requests.values()) - requests
+            results[run] = {'seconds': round(elapsed, 3), 'requests': requests}
+        pages = results['cold']['requests']
+        for run in results:
+            results[run]['pages_per_sec'] = round(pages / results[run]['seconds'], 1)
+        results['geocoder'] = json.loads(server.stats.to_json())['geocoder']
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def ratios(results, baseline):
+    """{path: results / baseline} of every */sec figure"""
+    found = OrderedDict()
+
+    def walk(new, old, path):
+        for key in sorted(new):
+            if key not in old:
+                continue
+            if isinstance(new[key], dict) and isinstance(old[key], dict):
+                walk(new[key], old[key], path + [key])
+            elif key.endswith('_per_sec') and old[key]:
+                found['.'.join(path + [key])] = round(float(new[key]) / old[key], 2)
+
+    walk(results, baseline, [])
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmark suite")
+    parser.add_argument('-n', '--listings', default=300, type=int, help="listings per site to parse / to scan")
+    parser.add_argument('--repeat', default=3, type=int, help="parse runs per site, the fastest one counts")
+    parser.add_argument('--searches', default=4, type=int, help="search urls to crawl")
+    parser.add_argument('--depth', default=5, type=int, help="pages per search")
+    parser.add_argument('--apartments', default=20000, type=int, help="apartments to score")
+    parser.add_argument('-j', '--jobs', default=8, type=int, help="--jobs for the crawl and the end-to-end runs")
+    parser.add_argument('--stages', default=['parse', 'links', 'score', 'end_to_end'], nargs='+',
+                        help="stages to run")
+    parser.add_argument('-o', '--output', help="write the results to the file")
+    parser.add_argument('--baseline', help="compare with the results of a previous run")
+    args = parser.parse_args()
+
+    scanner = load_scanner()
+    server = StubServer().start()
+    results = OrderedDict([('benchmark', 'suite'), ('python', sys.version.split()[0])])
+    try:
+        if 'parse' in args.stages:
+            results['parse'] = bench_parse(scanner, args)
+        if 'links' in args.stages:
+            results['links'] = bench_links(scanner, server, args)
+        if 'score' in args.stages:
+            results['score'] = bench_score(scanner, args)
+        if 'end_to_end' in args.stages:
+            results['end_to_end'] = bench_end_to_end(server, args)
+    finally:
+        server.shutdown()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['baseline'] = ratios(results, json.load(f))
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
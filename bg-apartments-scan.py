@@ -1,26 +1,68 @@
 #!/usr/bin/env python
 # -*- coding: cp1251 -*-
 
-from __future__ import print_function
+from __future__ import print_function, unicode_literals
 
+import io
 import os
+import math
+import sys
 import time
+import random
 import argparse
 import logging
 import re
 import tempfile
 import shutil
+import signal
+import threading
+import sqlite3
+import zlib
+import codecs
 import hashlib
+import heapq
+import operator
+import json
+import email.utils
 import configparser
+from array import array
+from collections import OrderedDict, deque
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from geopy import distance, geocoders
-from geopy.exc import GeocoderTimedOut, GeocoderQuotaExceeded
+from geopy.exc import GeopyError, GeocoderTimedOut, GeocoderQuotaExceeded
 
 try:
     # For Python 3.0 and later
-    from urllib.request import urlopen, HTTPError
+    from urllib.request import HTTPError, getproxies, proxy_bypass
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
 except ImportError:
     # Fall back to Python 2's urllib2
-    from urllib2 import urlopen, HTTPError
+    from urllib2 import HTTPError
+    from urllib import getproxies, proxy_bypass
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+
+try:
+    from urllib.parse import urlparse, urljoin
+except ImportError:
+    from urlparse import urlparse, urljoin
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 reInt = [re.compile(r'[\s>]*(\d+)[\s<]*')]
 reSqm = [re.compile(r': (\d+) .'),
@@ -94,27 +136,509 @@ rePrestigious = [re.compile(r'[ ,>](prestigious)', re.IGNORECASE)]
 reRenovated = [re.compile(r'[ ,>](renovated)', re.IGNORECASE)]
 reFireplace = [re.compile(r'[ ,>](fireplace)', re.IGNORECASE)]
 reRestaurants = [re.compile(r'[ ,>](restaurant)', re.IGNORECASE)]
-reApartmentLink = [re.compile(r'//(www.imot.bg/pcgi/imot.cgi\?act=5&adv=\S+?&slink=\S+?)"'),
-                   re.compile(r'(https://ues.bg/en/offers/[1-9]\S+?)["<\s]'),
-                   re.compile(r'<a class="offer-link"\s+href="(https://www.luximmo.com/\S+.html)">')]
-reImg = [re.compile(r'src=\"(//imot.focus.bg/photosimotbg/\S+small\S+?.pic)'),
-         re.compile(r'src=\"(//imot.focus.bg/photosimotbg/\S+med\S+?.jpg)'),
-         re.compile(r'url\(\'(https://image.ues.bg[/]+estates/watermark/\S+?.jpg)\'', re.IGNORECASE),
-         re.compile(r'"image":"(https:\\/\\/static.luximo.ru\\/property-images\\/\S+?.jpg)', re.IGNORECASE)]
-reStopWord = [re.compile(r"Contact us"),
-              re.compile(r" :<")]
-
-reAZ = re.compile("[^a-zA-Z0-9]")
+reImotLink = [re.compile(r'//(www.imot.bg/pcgi/imot.cgi\?act=5&adv=\S+?&slink=\S+?)"')]
+reUesLink = [re.compile(r'(https://ues.bg/en/offers/[1-9]\S+?)["<\s]')]
+reLuximmoLink = [re.compile(r'<a class="offer-link"\s+href="(https://www.luximmo.com/\S+.html)">')]
+reApartmentLink = reImotLink + reUesLink + reLuximmoLink
+reImotImg = [re.compile(r'src=\"(//imot.focus.bg/photosimotbg/\S+small\S+?.pic)'),
+             re.compile(r'src=\"(//imot.focus.bg/photosimotbg/\S+med\S+?.jpg)')]
+reUesImg = [re.compile(r'url\(\'(https://image.ues.bg[/]+estates/watermark/\S+?.jpg)\'', re.IGNORECASE)]
+reLuximmoImg = [re.compile(r'"image":"(https:\\/\\/static.luximo.ru\\/property-images\\/\S+?.jpg)', re.IGNORECASE)]
+reImg = reImotImg + reUesImg + reLuximmoImg
+reStopWordEn = [re.compile(r"Contact us")]
+reStopWordBg = [re.compile(r" :<")]
+reStopWord = reStopWordEn + reStopWordBg
+reTag = re.compile(r'<[^>]*>')
+reWord = re.compile(r'\w+', re.UNICODE)
+reCharset = re.compile(r'charset\s*=\s*["\']?([\w-]+)', re.IGNORECASE)
+reMetaCharset = re.compile(br'<meta[^>]+charset\s*=\s*["\']?([\w-]+)', re.IGNORECASE)
+
+# extraction rules applied to every line in order: (property, literal or regexps[, value[, overwrite]])
+RULES = [
+    ('sqm', reSqm),
+    ('rooms', reRooms),
+    ('rooms', reRoomsMany, 5),
+    ('bedrooms', reBedrooms),
+    ('elevator', reElevator, 1),
+    ('internet', ' '),
+    ('internet', 'internet'),
+    ('luxe', '</div>'),
+    ('garage', '</div>'),
+    ('garage', '  '),
+    ('garage', 'garage'),
+    ('parkslot', '</div>'),
+    ('parkslot', 'parking'),
+    ('parkslot', 'no parking', 0, True),
+    ('parkslot', 'underground parking', 1, True),
+    ('park', 'park environment', 1),
+    ('park', rePark, 1),
+    ('garden', reGarden, 1),
+    ('district', reDistrict),
+    ('street', reStreet),
+    ('street_full', reStreetFull),
+    ('subway', reSubway, 1),
+    ('city', reCity, None, True),
+    ('price', rePrice, None, True),
+    ('price_wo_vat', rePriceWoVat),
+    ('floor', reFloor),
+    ('floor_max', reFloorMax),
+    ('furniture', ' </div>'),
+    ('furniture', ' with furniture'),
+    ('furniture', 'partly furnished', 0, True),
+    ('furniture', 'fully furnished', 1, True),
+    ('cozy', 'cozy'),
+    ('cozy', 'coziness'),
+    ('pool', rePool, 1),
+    ('calm', reCalm, 1),
+    ('fireplace', reFireplace, 1),
+    ('unique', reFireplace, 1),
+    ('luxury', reLuxury, 1),
+    ('bath', reBath, 1),
+    ('prestigious', rePrestigious, 1),
+    ('renovated', reRenovated, 1),
+    ('gym', reGym, 1),
+    ('restaurants', reRestaurants, 1),
+    ('location', reLocation, 1),
+    ('location', 'Search by basic location', 0, True),
+    ('mall', reMall, 1),
+    ('transport', reTransport, 1),
+    ('leisure', reLeisure, 1),
+    ('balcony', ' '),
+    ('balcony', ' '),
+    ('balcony', ' '),
+    ('balcony', 'terrace'),
+    ('balcony', 'balcony'),
+    ('view', ' ', 'View'),
+    ('view', ' ', 'View'),
+    ('view', '  ', 'Rock View', True),
+    ('view', ' ', 'Rock View', True),
+    ('view', ' ', 'Panorama', True),
+    ('view', ' ', 'Panorama', True),
+    ('view', ' ', 'Panorama', True),
+    ('view', 'great view', 'View'),
+    ('view', 'amazing view', 'View'),
+    ('view', 'nice view', 'View'),
+    ('view', 'beautiful views', 'View'),
+    ('view', 'panoramic', 'Panorama', True),
+    ('view', 'panoramik', 'Panorama', True),
+    ('view', reMountain, 'Rock View', True),
+]
 
 CACHE_DIR = os.path.join(tempfile.gettempdir(), 'aparts-scanner')
 
+# the page cache, see PageCache
+PAGES = None
+
+# the geocoding cache, see GeoCache
+GEOCODES = None
+
+# the parsed listings store, see ListingStore
+LISTINGS = None
+
+# (location, point) -> km
+DISTANCES = {}
+
+# the points of interest of --poi, see Pois
+POIS = None
+
+# listing filters of --filter and the [FILTERS] config section
+FILTERS = None
+
+# stage timers and counters of --profile, see Profile
+PROFILE = None
+
+# download the whole pages, not only up to the stop words (--full-pages)
+FULL_PAGES = False
+
+# value -> the same value, the strings shared by all the apartments, see Apartment.compact()
+SHARED = {}
+
+# the HTML report is in the charset its HEADER declares
+REPORT_CHARSET = 'cp1251'
+
+# attempts of a failed request, the wait before the next one doubles from BACKOFF seconds up to BACKOFF_MAX
+RETRIES = 5
+BACKOFF = 1.0
+BACKOFF_MAX = 60.0
+
 VIEWS = {"View": 1, "Panorama": 2, "Rock View": 3}
 
+# scored attributes, in the order of the feature matrix columns
+SCORE_ATTRS = ('price', 'rooms', 'sqm', 'floor', 'elevator', 'internet',
+               'location', 'mall',
+               'luxe', 'view', 'calm', 'fireplace', 'unique', 'luxury', 'bath', 'leisure',
+               'pool', 'restaurants', 'supermarket', 'balcony', 'park', 'garden', 'garage', 'parkslot',
+               'furniture', 'cozy', 'subway', 'distance')
+
+# values scored for unknown (zero) attributes
+SCORE_DEFAULTS = {'distance': 4.0, 'price': 1000.0, 'floor': 2}
+
+# --poi features of every kind of points: "<kind>_km" to the nearest one and "<kind>_500m", the number of
+# them within POI_RADIUS_KM; the points are indexed on a grid of POI_CELL_KM cells
+POI_RADIUS_KM = 0.5
+POI_CELL_KM = 0.5
+EARTH_KM = 6371.0088
+
+# near-duplicate listings: a MinHash signature of the fields (SIGNATURE hashes cut into BANDS bands for LSH)
+# and a bottom-k sketch of the image names and text shingles (the SKETCH smallest hashes), see Duplicates
+SIGNATURE = 32
+BANDS = 8
+SKETCH = 16
+MERSENNE = (1 << 31) - 1
+
+# listings of the same website with alike fields are duplicates if their sketches are this similar
+CONTENT_SIMILARITY = 0.5
+
+TRANSLIT = dict(zip("",
+                    ["a", "b", "v", "g", "d", "e", "zh", "z", "i", "y", "k", "l", "m", "n", "o", "p", "r", "s", "t",
+                     "u", "f", "h", "ts", "ch", "sh", "sht", "a", "y", "yu", "ya"]))
+
+# transliterated words of the place names before the name: street and district types
+PLACE_TYPES = ("ul", "ulitsa", "bul", "bulevard", "blvd", "boulevard", "str", "street", "pl", "ploshtad", "square",
+               "zh", "k", "zhk", "kv", "kvartal", "g", "gr", "grad", "m", "mestnost")
+# ... and after a street name: house numbers, blocks, entrances and a second street
+HOUSE_WORDS = ("no", "nomer", "bl", "blok", "vh", "vhod", "et", "etazh", "ap", "i")
+
+
+def literal_of(regexp):
+    """Longest literal every match of the regexp contains, lowercased (None if there is no such literal)"""
+
+    def walk(items, run, best):
+        for op, av in items:
+            if op == sre_parse.LITERAL:
+                run = run + [av]
+                if len(run) > len(best):
+                    best = run
+            elif op == sre_parse.SUBPATTERN:
+                run, best = walk(av[-1], run, best)
+            else:
+                run = []
+        return run, best
+
+    _, best = walk(sre_parse.parse(regexp.pattern, regexp.flags), [], [])
+    if not best:
+        return None
+    return "".join("%c" % c for c in best).lower()
+
+
+def trie_pattern(literals):
+    """Regexp matching any of the literals, with common prefixes merged so the regexp engine
+    walks a trie instead of trying every literal at every position"""
+    trie = {}
+    for lit in literals:
+        node = trie
+        for c in lit:
+            node = node.setdefault(c, {})
+        node[None] = None
+
+    def build(node):
+        branches = [re.escape(c) + build(child) for c, child in sorted(node.items(), key=lambda i: i[0] or "")
+                    if c is not None]
+        if not branches:
+            return ""
+        group = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return "(?:" + group + ")?" if None in node else group
+
+    return build(trie)
+
+
+class RuleEngine:
+    """
+    Extraction rules compiled once into a single matcher.
+
+    Every rule is reduced to the literals it can't match without (the keyword itself or the longest
+    literal part of each regexp), and all literals are joined into one gate regexp. A line is lowercased
+    once and scanned by the gate; most HTML lines have no hit and are skipped. For the rest, the literals
+    found select the few rules worth checking, which are then applied in order with the same semantics
+    as Apartment.parse().
+    """
+
+    def __init__(self, rules, images=reImg, stop_words=reStopWord):
+        self.rules = []
+        owners = {}
+        for n, rule in enumerate(rules):
+            prop, regexp = rule[0], rule[1]
+            val = rule[2] if len(rule) > 2 else None
+            overwrite = rule[3] if len(rule) > 3 else False
+            if isinstance(regexp, type("")):
+                regexps = None
+                literals = [regexp.lower()]
+            else:
+                regexps = [(literal_of(r), r) for r in regexp]
+                literals = [lit for lit, _ in regexps]
+            for lit in literals:
+                owners.setdefault(lit, set()).add(n)
+            self.rules.append((prop, regexp.lower() if regexps is None else None, regexps, val, overwrite,
+                               rule_name(prop, regexp)))
+
+        for r in list(images) + list(stop_words):
+            owners.setdefault(literal_of(r), set())
+
+        if None in owners or "" in owners:
+            self.gate = None
+            return
+
+        # the gate reports the longest literal starting at a position, shorter ones inside it are implied
+        self.candidates = {}
+        for lit in owners:
+            self.candidates[lit] = set()
+            for other, indexes in owners.items():
+                if other in lit:
+                    self.candidates[lit].update(indexes)
+        self.gate = re.compile(trie_pattern(owners))
+
+    def match(self, apartment, line):
+        """Apply the rules to the line, returns the stripped line if it may hold anything else (images,
+        stop words), None otherwise"""
+        line = line.strip()
+        lower = line.lower()
+
+        if self.gate:
+            m = self.gate.search(lower)
+            if not m:
+                return None
+            found = set()
+            while m:
+                found.update(self.candidates[m.group()])
+                m = self.gate.search(lower, m.start() + 1)
+            rules = [self.rules[n] for n in sorted(found)]
+        else:
+            rules = self.rules
+
+        profile = PROFILE
+        apply = self.apply
+        for rule in rules:
+            if profile:
+                started = time.time()
+                found = apply(apartment, rule, line, lower)
+                profile.rule(rule[5], found, time.time() - started)
+            else:
+                apply(apartment, rule, line, lower)
+        return line
+
+    @staticmethod
+    def apply(apartment, rule, line, lower):
+        """Apply a rule to the line, True if it sets the property"""
+        prop, literal, regexps, val, overwrite, _ = rule
+        if not overwrite:
+            v = getattr(apartment, prop)
+            if v and v != "-":
+                return False
+        if regexps is None:
+            if literal not in lower:
+                return False
+            v = 1 if val is None else val
+        else:
+            for lit, r in regexps:
+                if lit is not None and lit not in lower:
+                    continue
+                m = r.search(line)
+                if m:
+                    v = m.group(1) if val is None else val
+                    break
+            else:
+                return False
+        setattr(apartment, prop, v)
+        logging.debug("  found: %s = %s (%s)" % (prop, v, line))
+        return True
+
+
+def rule_name(prop, regexp):
+    """Name of a rule in the --profile summary: the property and the keyword or the re* list of the regexps"""
+    if isinstance(regexp, type("")):
+        return "%s: '%s'" % (prop, regexp)
+    names = sorted((len(v), name) for name, v in globals().items()
+                   if name.startswith("re") and isinstance(v, list) and regexp[0] in v)
+    return "%s: %s" % (prop, names[0][1] if names else regexp[0].pattern)
+
+
+def is_bulgarian(pattern):
+    """True for a rule literal or regexp with cyrillic characters"""
+    if not isinstance(pattern, type("")):
+        pattern = pattern.pattern
+    return any(ord(c) > 127 for c in pattern)
+
+
+def select_rules(rules, keep):
+    """Rules with only the literals and regexps keep() accepts, rules left without any are dropped"""
+    selected = []
+    for rule in rules:
+        if isinstance(rule[1], type("")):
+            if keep(rule[1]):
+                selected.append(rule)
+        else:
+            regexps = [r for r in rule[1] if keep(r)]
+            if regexps:
+                selected.append((rule[0], regexps) + tuple(rule[2:]))
+    return selected
+
+
+class Site:
+    """
+    Extractor for a website: the rules, stop words and image patterns that apply to its
+    pages, the patterns of apartment links on its search pages, the query parameter
+    with the number of a search results page and the charset of the pages that don't
+    declare one.
+    """
+
+    def __init__(self, name, rules, stop_words, images, links, attrs=None, page_param=None, charset=None):
+        self.name = name
+        self.rules = rules
+        self.stop_words = stop_words
+        self.images = images
+        self.links = links
+        self.attrs = attrs or {}
+        self.page_param = page_param
+        self.charset = charset
+        self.engine = RuleEngine(rules, images, stop_words)
+        self.raw_stop_words = {}
+
+    def matches(self, url):
+        host = urlparse(url).netloc.lower()
+        return host == self.name or host.endswith("." + self.name)
+
+    def nextPage(self, url):
+        """URL of the next search results page, None if the website has no pagination"""
+        if not self.page_param:
+            return None
+        m = re.search(r'([?&]%s=)(\d*)' % re.escape(self.page_param), url)
+        if not m:
+            return "%s%s%s=2" % (url, "&" if "?" in url else "?", self.page_param)
+        return url[:m.start(2)] + str(int(m.group(2) or 1) + 1) + url[m.end(2):]
+
+    def isStop(self, line, charset=None):
+        """True if the raw (not decoded) page line has a stop word, nothing after it is parsed"""
+        charset = charset or self.charset or 'utf-8'
+        stop_words = self.raw_stop_words.get(charset)
+        if stop_words is None:
+            # the stop words encoded in the page charset are found without decoding the lines
+            stop_words = self.raw_stop_words[charset] = [
+                re.compile(r.pattern.encode(charset, 'ignore'), r.flags & ~re.UNICODE) for r in self.stop_words]
+        return any(r.search(line) for r in stop_words)
+
+    def parseLine(self, apartment, line, state):
+        """Site specific parsing of a line, the state is kept between the lines of a page"""
+        return state
+
+    def finish(self, apartment):
+        for attr, val in self.attrs.items():
+            setattr(apartment, attr, val)
+
+
+class Luximmo(Site):
+    def parseLine(self, apartment, line, parse_next):
+        # the values follow their labels on the next lines
+        if parse_next == "price":
+            try:
+                apartment.price = int(line.replace("\"", "").replace(" ", ""))
+            except ValueError as e:
+                pass
+            parse_next = ""
+
+        elif parse_next == "floor":
+            apartment.parse('floor', reInt, line)
+            if apartment.floor:
+                parse_next = ""
+
+        elif parse_next == "num_of_floors":
+            apartment.parse('floor_max', reInt, line)
+            if apartment.floor_max:
+                parse_next = ""
+
+        if "curr_conv" in line:
+            parse_next = "price"
+        elif "Floor:" in line:
+            parse_next = "floor"
+        elif "Number of floors:" in line:
+            parse_next = "num_of_floors"
+
+        return parse_next
+
+
+SITES = [
+    # imot.bg pages are in bulgarian, the price is the only english pattern there
+    Site("imot.bg", select_rules(RULES, lambda p: is_bulgarian(p) or p is rePrice[0]),
+         reStopWordBg, reImotImg, reImotLink, page_param='f1', charset='cp1251'),
+    Site("ues.bg", select_rules(RULES, lambda p: not is_bulgarian(p)),
+         reStopWordEn, reUesImg, reUesLink, attrs={'luxe': 1}, page_param='page', charset='utf-8'),
+    Luximmo("luximmo.com", select_rules(RULES, lambda p: not is_bulgarian(p)),
+            reStopWordEn, reLuximmoImg, reLuximmoLink, page_param='page', charset='utf-8'),
+]
+
+# pages of other websites go through all the rules
+GENERIC_SITE = Site(None, RULES, reStopWord, reImg, reApartmentLink)
+
+
+def site_of(url):
+    for site in SITES:
+        if site.matches(url):
+            return site
+    return GENERIC_SITE
+
+
+def charset_of(content_type):
+    """Charset of a Content-Type header, None if it has none or Python doesn't know it"""
+    m = reCharset.search(content_type or "")
+    return known_charset(m.group(1)) if m else None
+
+
+def known_charset(name):
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+
+def page_charset(data, charset=None, site=None):
+    """Charset of the page: that of the HTTP headers, of its <meta> tags or the site default, in that order,
+    None if unknown"""
+    if not charset:
+        m = reMetaCharset.search(data, 0, 4096)
+        charset = (m and known_charset(m.group(1).decode('ascii'))) or (site and site.charset)
+    return charset
+
+
+def decode_page(data, charset=None, site=None):
+    """(text, charset) of the page: the page is decoded at once with its page_charset(), or else as UTF-8
+    falling back to cp1251"""
+    charset = page_charset(data, charset, site)
+    if not charset:
+        try:
+            return data.decode('utf-8'), 'utf-8'
+        except UnicodeDecodeError:
+            charset = 'cp1251'
+    return data.decode(charset, 'replace'), charset
+
+
+def page_lines(data, charset=None, site=None):
+    """Decoded lines of the page, see decode_page()"""
+    with Stage('decode'):
+        return decode_page(data, charset, site)[0].split("\n")
+
+
+class Apartment(object):
+    __slots__ = ('id', 'url', 'duplicates', 'poi', 'rejected', 'score', 'district', 'country', 'city', 'street',
+                 'street_full', 'geolocation', 'subway', 'price', 'price_wo_vat', 'rooms', 'bedrooms', 'sqm',
+                 'location', 'mall', 'supermarket', 'transport', 'leisure', 'pool', 'calm', 'fireplace', 'unique',
+                 'luxury', 'bath', 'prestigious', 'renovated', 'gym', 'restaurants', 'floor', 'floor_max',
+                 'elevator', 'internet', 'luxe', 'view', 'balcony', 'park', 'garden', 'garage', 'parkslot',
+                 'furniture', 'cozy', 'distance', 'partial', 'sketch', 'images_list', 'images_set')
+
+    # the fields kept in the parsed listings store: all but id, url, duplicates, poi, rejected and images_set
+    PARSED = __slots__[5:-1]
+
+    # the fields a duplicate can't fill in, see merge()
+    UNMERGED = ('score', 'distance', 'partial', 'sketch', 'images_list')
+
+    # repeated strings shared by all the apartments
+    INTERNED = ('district', 'country', 'city', 'street', 'street_full')
 
-class Apartment:
     def __init__(self, id, url):
         self.id = id
         self.url = url
+        self.duplicates = None
+        self.poi = None
+        self.rejected = False
         self.score = 0
         self.district = ""
         self.country = ""
@@ -158,6 +682,9 @@ class Apartment:
         self.furniture = 0
         self.cozy = 0
         self.distance = 0
+        # parsed only up to a field failing the filters
+        self.partial = False
+        self.sketch = None
 
         self.images_list = []
         self.images_set = set()
@@ -216,11 +743,17 @@ class Apartment:
             facilities.append("transport")
         if self.leisure:
             facilities.append("leisure")
+        if self.poi:
+            for kind in POIS.points:
+                facilities.append("%s %.1f km" % (kind, self.poi["%s_km" % kind]))
 
         try:
             link_name = self.url.split("/")[2]
         except RuntimeException as e:
             link_name = "link"
+        links = "<a target=_blank href='%s'>%s</a>" % (self.url, link_name)
+        for url in self.duplicates or ():
+            links += " <a target=_blank href='%s'>%s</a>" % (url, url.split("/")[2])
 
         return (("<tr class='grid' id='%d'><td>%s</td><td>%d</td><td>%s</td><td>%s</td><td>%s</td>"
                  "<td>%s</td><td>%s</td><td>%s</td><td>%s</td>"
@@ -228,7 +761,7 @@ class Apartment:
                  "<td>%s</td><td>%s</td><td>%s</td>"
                  "<td>%s</td><td>%s</td><td>%.1f</td>"
                  "<td>%s</td>"
-                 "<td><a target=_blank href='%s'>%s</a></td></tr>") %
+                 "<td>%s</td></tr>") %
                 (self.id, self.id, int(self.score), self.district, self.street, self.price,
                  self.rooms, self.sqm, self.floor, self.floor_max,
                  "Elevator" if self.elevator else "-",
@@ -239,7 +772,7 @@ class Apartment:
                  "Garage" if self.garage else ("Parkslot" if self.parkslot else "-"),
                  "Cozy" if self.cozy else ("Furnit" if self.furniture else "-"),
                  "Metro" if self.subway else "-",
-                 self.distance, img, self.url, link_name))
+                 self.distance, img, links))
 
     def getBigImages(self):
         images = "".join("<img class=\"imgbig\" src=\"%s\">" % i for i in self.images_list)
@@ -248,8 +781,8 @@ class Apartment:
             images = images.replace("/med/", "/big/")
         return images
 
-    def parseImages(self, line):
-        for r in reImg:
+    def parseImages(self, line, images=reImg):
+        for r in images:
             for link in r.findall(line):
                 if link in self.images_set:
                     continue
@@ -260,158 +793,179 @@ class Apartment:
                     link = link.replace('small', 'med')
                 if "luximo" in link or "luximmo" in link:
                     link = link.replace('\\', '')
+                try:
+                    # ASCII links as native strings, a quarter of the memory of Python 2 unicode
+                    link = str(link)
+                except UnicodeEncodeError:
+                    pass
                 self.images_list.append(link)
                 logging.debug("    img: %s" % link)
 
     def parse(self, property, regexp, line, val=None, overwrite=False):
-        if property and not overwrite and self.__dict__[property] and self.__dict__[property] != "-":
+        if property and not overwrite and getattr(self, property) and getattr(self, property) != "-":
             return False
 
         line = line.strip()
 
-        if type(regexp) == str:
+        if isinstance(regexp, type("")):
             if regexp.lower() not in line.lower():
                 return False
             if property:
-                self.__dict__[property] = 1 if val is None else val
-                logging.debug("  found: %s = %s (%s)" % (property, str(self.__dict__[property]), line))
+                setattr(self, property, 1 if val is None else val)
+                logging.debug("  found: %s = %s (%s)" % (property, getattr(self, property), line))
             return True
         else:
             for r in regexp:
                 m = r.search(line)
                 if m:
                     if property:
-                        self.__dict__[property] = m.group(1) if val is None else val
-                        logging.debug("  found: %s = %s (%s)" % (property, str(self.__dict__[property]), line))
+                        setattr(self, property, m.group(1) if val is None else val)
+                        logging.debug("  found: %s = %s (%s)" % (property, getattr(self, property), line))
                     return True
         return False
 
-    def getHtml(self):
-        p = os.path.join(CACHE_DIR, reAZ.sub('_', self.url))
-        if os.path.exists(p):
-            f = open(p)
-            data = f.readlines()
+    def getHtml(self, revalidate=False):
+        """Decoded lines of the page"""
+        data, charset = self.getPage(revalidate)
+        return page_lines(data, charset, site_of(self.url))
+
+    def getPage(self, revalidate=False):
+        """(page bytes, charset) as downloaded or cached, the charset is None if the page doesn't tell"""
+        site = site_of(self.url)
+        entry = PAGES.get(self.url)
+        if entry and entry.fresh and not revalidate:
             logging.info("from cache: %s" % self.url)
-            f.close()
-        else:
-            logging.info("fetching url: %s" % self.url)
-            try:
-                response = url_open(self.url)
-            except HTTPError as e:
-                return ""
-            data = response.read()
-            f = open(p, 'w')
-            f.write(data)
-            f.close()
-            data = data.split('\n')
-        return data
+            count('pages.hit')
+            return entry.data, entry.charset
+
+        headers = {}
+        if entry and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+
+        logging.info("%s url: %s" % ("revalidating" if entry else "fetching", self.url))
+        try:
+            with Stage('fetch'):
+                response = url_open(self.url, headers)
+                charset = charset_of(response.headers.get('Content-Type'))
+                data = read_page(response, None if FULL_PAGES else site, charset)
+        except (IOError, HTTPException) as e:
+            # the HTTP errors and the network errors url_open() gave up on
+            if not entry:
+                count('pages.miss')
+                logging.warning("can't fetch: %s - %s" % (self.url, str(e)))
+                return b"", None
+            if getattr(e, 'code', None) == 304:
+                count('pages.not_modified')
+                PAGES.revalidated(self.url)
+            else:
+                count('pages.stale')
+                logging.warning("using stale cache: %s - %s" % (self.url, str(e)))
+            return entry.data, entry.charset
+
+        count('pages.miss')
+        charset = page_charset(data, charset, site)
+        PAGES.put(self.url, data, response.headers.get('ETag'), response.headers.get('Last-Modified'), charset)
+        return data, charset
+
+    def scan(self, data=None):
+        if data is None:
+            data = self.getHtml()
+
+        with Stage('scan'):
+            self.parsePage(data)
+
+    def scanPage(self, page, digest=False):
+        """Decode and parse the (page bytes, charset), returns the page digest if asked for or stored"""
+        data, charset = page
+        with Stage('decode'):
+            text, _ = decode_page(data, charset, site_of(self.url))
+        digest = text_digest(text) if digest or LISTINGS else None
+        with Stage('scan'):
+            self.parsePage(text.split("\n"), digest)
+        return digest
+
+    def loadPage(self, page):
+        """Take the fields of the (page bytes, charset) from the parsed listings store, returns the page digest
+        if they were there, None if the page has to be parsed"""
+        if not LISTINGS.has(self.url):
+            count('listings.miss')
+            return None
+        data, charset = page
+        with Stage('decode'):
+            text, _ = decode_page(data, charset, site_of(self.url))
+        digest = text_digest(text)
+        return digest if self.load(digest) else None
+
+    def parsePage(self, data, digest=None):
+        if LISTINGS and digest is None:
+            digest = page_digest(data)
+        if self.load(digest):
+            return
+        self.extract(data)
+        self.compact()
+        self.save(digest)
+
+    def load(self, digest):
+        """Take the fields from the parsed listings store if the page didn't change, True if found"""
+        if not LISTINGS:
+            return False
+        fields = LISTINGS.get(self.url, digest)
+        if fields is not None and fields.get('partial'):
+            parsed = Apartment(self.id, self.url)
+            parsed.update(fields)
+            if not (FILTERS and FILTERS.rejects(parsed)):
+                # parsed up to a filter this run doesn't have
+                fields = None
+        count('listings.hit' if fields is not None else 'listings.miss')
+        if fields is None:
+            return False
+        self.update(fields)
+        return True
+
+    def save(self, digest):
+        if LISTINGS:
+            LISTINGS.put(self.url, digest, self.fields())
 
-    def scan(self):
-        data = self.getHtml()
+    def fields(self):
+        return dict((attr, getattr(self, attr)) for attr in self.PARSED)
 
-        parse_next = False
+    def values(self):
+        return tuple(getattr(self, attr) for attr in self.PARSED)
+
+    def update(self, fields):
+        for attr, v in fields.items():
+            setattr(self, attr, v)
+        self.compact()
+
+    def extract(self, data):
+        """Parse the fields from the page lines"""
+        site = site_of(self.url)
+        state = None
+        profile = PROFILE
+        early = FILTERS.early if FILTERS else None
+        text = []
 
         for line in data:
-            try:
-                line = line.decode('utf-8').encode('cp1251', 'ignore')
-            except UnicodeDecodeError as e:
-                pass
-            self.parse('sqm', reSqm, line)
-            self.parse('rooms', reRooms, line)
-            self.parse('rooms', reRoomsMany, line, 5)
-            self.parse('bedrooms', reBedrooms, line)
-            self.parse('elevator', reElevator, line, 1)
-            self.parse('internet', ' ', line)
-            self.parse('internet', 'internet', line)
-            self.parse('luxe', '</div>', line)
-            self.parse('garage', '</div>', line)
-            self.parse('garage', '  ', line)
-            self.parse('garage', 'garage', line)
-            self.parse('parkslot', '</div>', line)
-            self.parse('parkslot', 'parking', line)
-            self.parse('parkslot', 'no parking', line, 0, overwrite=True)
-            self.parse('parkslot', 'underground parking', line, 1, overwrite=True)
-            self.parse('park', 'park environment', line, 1)
-            self.parse('park', rePark, line, 1)
-            self.parse('garden', reGarden, line, 1)
-            self.parse('district', reDistrict, line)
-            self.parse('street', reStreet, line)
-            self.parse('street_full', reStreetFull, line)
-            self.parse('subway', reSubway, line, 1)
-            self.parse('city', reCity, line, overwrite=True)
-            self.parse('price', rePrice, line, overwrite=True)
-            self.parse('price_wo_vat', rePriceWoVat, line)
-            self.parse('floor', reFloor, line)
-            self.parse('floor_max', reFloorMax, line)
-            self.parse('furniture', ' </div>', line)
-            self.parse('furniture', ' with furniture', line)
-            self.parse('furniture', 'partly furnished', line, 0, overwrite=True)
-            self.parse('furniture', 'fully furnished', line, 1, overwrite=True)
-            self.parse('cozy', 'cozy', line)
-            self.parse('cozy', 'coziness', line)
-            self.parse('pool', rePool, line, 1)
-            self.parse('calm', reCalm, line, 1)
-            self.parse('fireplace', reFireplace, line, 1)
-            self.parse('unique', reFireplace, line, 1)
-            self.parse('luxury', reLuxury, line, 1)
-            self.parse('bath', reBath, line, 1)
-            self.parse('prestigious', rePrestigious, line, 1)
-            self.parse('renovated', reRenovated, line, 1)
-            self.parse('gym', reGym, line, 1)
-            self.parse('restaurants', reRestaurants, line, 1)
-            self.parse('location', reLocation, line, 1)
-            self.parse('location', 'Search by basic location', line, 0, overwrite=True)
-            self.parse('mall', reMall, line, 1)
-            self.parse('transport', reTransport, line, 1)
-            self.parse('leisure', reLeisure, line, 1)
-            self.parse('balcony', ' ', line)
-            self.parse('balcony', ' ', line)
-            self.parse('balcony', ' ', line)
-            self.parse('balcony', 'terrace', line)
-            self.parse('balcony', 'balcony', line)
-            self.parse('view', ' ', line, 'View')
-            self.parse('view', ' ', line, 'View')
-            self.parse('view', '  ', line, 'Rock View', overwrite=True)
-            self.parse('view', ' ', line, 'Rock View', overwrite=True)
-            self.parse('view', ' ', line, 'Panorama', overwrite=True)
-            self.parse('view', ' ', line, 'Panorama', overwrite=True)
-            self.parse('view', ' ', line, 'Panorama', overwrite=True)
-            self.parse('view', 'great view', line, 'View')
-            self.parse('view', 'amazing view', line, 'View')
-            self.parse('view', 'nice view', line, 'View')
-            self.parse('view', 'beautiful views', line, 'View')
-            self.parse('view', 'panoramic', line, 'Panorama', overwrite=True)
-            self.parse('view', 'panoramik', line, 'Panorama', overwrite=True)
-            self.parse('view', reMountain, line, 'Rock View', overwrite=True)
-
-            self.parseImages(line)
-
-            if "luximmo.com" in self.url:
-                if parse_next == "price":
-                    try:
-                        self.price = int(line.replace("\"", "").replace(" ", ""))
-                    except ValueError as e:
-                        pass
-                    parse_next = ""
-
-                elif parse_next == "floor":
-                    self.parse('floor', reInt, line)
-                    if self.floor:
-                        parse_next = ""
-
-                elif parse_next == "num_of_floors":
-                    self.parse('floor_max', reInt, line)
-                    if self.floor_max:
-                        parse_next = ""
-
-                if "curr_conv" in line:
-                    parse_next = "price"
-                elif "Floor:" in line:
-                    parse_next = "floor"
-                elif "Number of floors:" in line:
-                    parse_next = "num_of_floors"
-
-            if self.parse(None, reStopWord, line):
+            if profile:
+                started = time.time()
+                stripped = site.engine.match(self, line)
+                profile.add('rules', time.time() - started)
+            else:
+                stripped = site.engine.match(self, line)
+            if stripped is not None:
+                self.parseImages(line, site.images)
+                text.append(stripped)
+
+            state = site.parseLine(self, line, state)
+
+            if stripped is not None and self.parse(None, site.stop_words, stripped):
+                break
+
+            if early and stripped is not None and FILTERS.rejects(self, early):
+                count('filters.stopped')
+                self.partial = True
                 break
 
         for s in ("  ", "  "):
@@ -429,10 +983,39 @@ class Apartment:
         if self.price_wo_vat:
             self.price = float(self.price_wo_vat) * 1.20
 
-        if "ues.bg" in self.url:
-            self.luxe = 1
-
-    def getAddressesUtf8(self):
+        site.finish(self)
+        self.sketch = sketch(shingles(text) | self.imageTokens())
+
+    def fieldTokens(self):
+        """Tokens of the fields duplicates have alike: rounded sizes and prices, transliterated names"""
+        tokens = ["rooms:%s" % self.rooms, "floor:%s" % self.floor, "floor_max:%s" % self.floor_max]
+        if self.sqm:
+            tokens += grid('sqm', int(self.sqm), 5)
+        if self.price:
+            tokens += grid('price', math.log(float(self.price)), math.log(1.1))
+        tokens += ["district:" + w for w in name_key(self.district).split()]
+        tokens += ["street:" + w for w in name_key(self.street).split()]
+        return tokens
+
+    def imageTokens(self):
+        return set("img:" + link.rsplit("/", 1)[-1] for link in self.images_list)
+
+    def merge(self, other):
+        """Take the fields the apartment is missing from its duplicate"""
+        for attr in self.PARSED:
+            if attr not in self.UNMERGED and not getattr(self, attr) and getattr(other, attr):
+                setattr(self, attr, getattr(other, attr))
+        self.duplicates = (self.duplicates or []) + [other.url]
+
+    def compact(self):
+        """Share the repeated strings, drop what is needed only while parsing"""
+        for attr in self.INTERNED:
+            v = getattr(self, attr)
+            if isinstance(v, type("")):
+                setattr(self, attr, SHARED.setdefault(v, v))
+        self.images_set = None
+
+    def getAddresses(self):
         if not self.city:
             return None
 
@@ -444,92 +1027,1562 @@ class Apartment:
                      self.country + " " + self.city + " " + self.district + " " + self.street.split("  ")[0],
                      self.country + " " + self.city + " " + self.district + " " + self.street_full]
 
-        return [(a, a.decode('cp1251').encode('utf8')) for a in addresses]
-
-    def calcDistance(self, addr_str, addr_unicode, geolocator, location, location_str):
-        p = os.path.join(CACHE_DIR, hashlib.md5(addr_unicode + " " + location_str).hexdigest())
-        if os.path.exists(p):
-            f = open(p)
-            km = float(f.read())
-            f.close()
-
-            logging.debug("  distance from cache: %.1f (%s)" % (km, addr_str))
-        else:
-            logging.debug("  fetching distance...")
-            try:
-                _, self.geolocation = geolocator.geocode(addr_unicode, language="bg-BG", timeout=15)
-                km = float(distance.distance(location, self.geolocation).km)
-                logging.debug("  distance fetched: %.1f (%s)" % (km, addr_str))
-            except GeocoderTimedOut as e:
-                logging.debug("  can't determine geolocation of: %s - TIMED OUT" % addr_str)
-                return 0.0
-            except GeocoderQuotaExceeded as e:
-                logging.debug("  geocoder quota exceeded: %s" % addr_str)
-                time.sleep(2.0)
-                return 0.0
-            except TypeError as e:
-                logging.debug("  can't determine geolocation of: %s" % addr_str)
-                km = 0.0
-
-            f = open(p, 'w')
-            f.write(str(km))
-            f.close()
-
+        return addresses
+
+    def getPoint(self):
+        """Coordinates of the first address that is geocoded, None if none"""
+        for address in self.getAddresses() or []:
+            point = GEOCODES.lookup(address)
+            if point is not None:
+                return point
+        return None
+
+    def calcDistance(self, address, location):
+        point = GEOCODES.lookup(address)
+        if point is None:
+            logging.debug("  can't determine geolocation of: %s" % address)
+            return 0.0
+
+        self.geolocation = point
+        km = distance_km(location, point)
+        logging.debug("  distance: %.1f (%s)" % (km, address))
         return km
 
-    def initDistance(self, geolocator, location, location_str):
-        addresses = self.getAddressesUtf8()
+    def initDistance(self, location):
+        with Stage('distance'):
+            self.findDistance(location)
+
+    def findDistance(self, location):
+        addresses = self.getAddresses()
         if not addresses:
             return
+        if GEOCODES.offline(addresses[0]):
+            # the gazetteer point of the street, the other addresses are neither geocoded nor closer
+            addresses = addresses[:1]
 
         best = None
-        for (a_str, a_unicode) in addresses:
-            km = self.calcDistance(a_str, a_unicode, geolocator, location, location_str)
+        for address in addresses:
+            km = self.calcDistance(address, location)
             if km > 0.0 and (best is None or km < best):
                 best = km
                 self.distance = km
 
         if self.distance == 0:
-            logging.warning("  can't determine location for:\n  %s" % "\n  ".join([a[0] for a in addresses]))
+            logging.warning("  can't determine location for:\n  %s" % "\n  ".join(addresses))
         else:
             logging.debug("  distance: %.1f km" % self.distance)
 
+    def features(self):
+        """Scored values of the score_attrs()"""
+        values = []
+        for attr in SCORE_ATTRS:
+            v = getattr(self, attr)
+            if attr == "view":
+                v = VIEWS.get(v, 0)
+            elif not v:
+                v = SCORE_DEFAULTS.get(attr, 0)
+            values.append(float(v))
+        if POIS:
+            values += POIS.values(self.poi)
+        return values
+
     def calcScore(self, weights):
         self.score = 0
 
-        for attr in ('price', 'rooms', 'sqm', 'floor', 'elevator', 'internet',
-                     'location', 'mall',
-                     'luxe', 'view', 'calm', 'fireplace', 'unique', 'luxury', 'bath', 'leisure',
-                     'pool', 'restaurants', 'supermarket', 'balcony', 'park', 'garden', 'garage', 'parkslot',
-                     'furniture', 'cozy', 'subway', 'distance'):
-            if self.__dict__[attr]:
-                v = self.__dict__[attr]
-
-                if attr == "view":
-                    v = VIEWS.get(v, 0)
-                elif attr == "distance":
-                    v = float(v) if v else 4.0
-                elif attr == "price" and not v:
-                    v = 1000.0
-                elif attr == "floor" and not v:
-                    v = 2
-                else:
-                    v = float(v)
-
+        for attr, v in zip(score_attrs(), self.features()):
+            if v:
                 s = v * float(weights.get(attr, 0))
                 logging.debug("  subscore for '%s': %.1f" % (attr, s))
                 self.score += s
         logging.debug("  SCORE: %.1f" % self.score)
 
 
+def score_attrs():
+    """The scored attributes: SCORE_ATTRS and the --poi features"""
+    return SCORE_ATTRS + (POIS.features if POIS else ())
+
+
+def feature_matrix(apartments):
+    """numpy matrix of the apartments features: a row per apartment, a column per score_attrs()"""
+    matrix = numpy.zeros((len(apartments), len(score_attrs())))
+    for j, attr in enumerate(SCORE_ATTRS):
+        values = [getattr(a, attr) for a in apartments]
+        if attr == "view":
+            matrix[:, j] = [VIEWS.get(v, 0) for v in values]
+        else:
+            default = SCORE_DEFAULTS.get(attr, 0)
+            matrix[:, j] = [float(v) if v else default for v in values]
+    if POIS:
+        matrix[:, len(SCORE_ATTRS):] = [POIS.values(a.poi) for a in apartments]
+    return matrix
+
+
+def rank(apartments, profiles, top=None):
+    """Rank the apartments by every weights profile: yields (profile name, [(score, apartment)] best first),
+    only the top best apartments if given"""
+    if numpy is None or not apartments:
+        for name, weights in profiles.items():
+            scores = []
+            for a in apartments:
+                a.calcScore(weights)
+                scores.append(a.score)
+            if top:
+                yield name, heapq.nlargest(top, zip(scores, apartments), key=lambda x: x[0])
+            else:
+                yield name, sorted(zip(scores, apartments), key=lambda x: x[0], reverse=True)
+        return
+
+    weights = numpy.array([[float(w.get(attr, 0)) for w in profiles.values()] for attr in score_attrs()])
+    scores = numpy.dot(feature_matrix(apartments), weights)
+    for p, name in enumerate(profiles):
+        if top:
+            column = scores[:, p].tolist()
+            order = heapq.nlargest(top, range(len(column)), key=column.__getitem__)
+        else:
+            order = numpy.argsort(-scores[:, p], kind='mergesort')
+        yield name, [(scores[i, p], apartments[i]) for i in order]
+
+
+class Filter:
+    """
+    A listing filter, "<field><condition>": "price<=1500", "sqm>60", "rooms=2-3", "floor=2,4-6", "price==1500"
+    (numbers), "district=,", "district=!" (names, compared transliterated, "" takes
+    " 1" too), "furniture=yes", "garage=no". A number or a name the page doesn't have passes.
+    """
+
+    OPS = (("<=", operator.le), (">=", operator.ge), ("!=", operator.ne), ("<", operator.lt), (">", operator.gt))
+
+    # fields that can't be filtered: computed after the parsing or internal
+    UNFILTERED = ('score', 'country', 'geolocation', 'distance', 'partial', 'sketch', 'images_list')
+
+    def __init__(self, text):
+        # the command line arguments are bytes in Python 2
+        text = text if isinstance(text, type("")) else text.decode('utf-8')
+        m = re.match(r'\s*(\w+)\s*(.*)$', text, re.UNICODE)
+        self.field = m.group(1).lower() if m else ""
+        if self.field not in Apartment.PARSED or self.field in self.UNFILTERED:
+            raise ValueError("can't filter by \"%s\": %s" % (self.field, text))
+        condition = m.group(2).strip()
+        if condition.startswith("=="):
+            condition = condition[2:].strip()
+        elif condition.startswith("="):
+            condition = condition[1:].strip()
+        self.text = text.strip()
+
+        self.flag = self.compare = self.ranges = self.names = None
+        for op, test in self.OPS:
+            if condition.startswith(op):
+                self.compare = (test, self.number(condition[len(op):]))
+                break
+        else:
+            if condition.lower() in ("yes", "no"):
+                self.flag = condition.lower() == "yes"
+            elif re.match(r'^[\d.,\s-]+$', condition):
+                self.ranges = []
+                for part in condition.split(","):
+                    low, dash, high = part.partition("-")
+                    self.ranges.append((self.number(low), self.number(high if dash else low)))
+            else:
+                self.negate = condition.startswith("!")
+                self.names = [district_key(n) for n in condition.lstrip("!").split(",")]
+                self.keys = {}
+        # "1500-", "2--3" and "3-2" are no ranges
+        if self.compare and self.compare[1] is None or self.ranges and not all(
+                low is not None and high is not None and low <= high for low, high in self.ranges) or \
+                self.names is not None and not all(self.names):
+            raise ValueError("bad listing filter: %s" % text)
+        # the other fields are numbers: "price=cheap" would compare a number with names
+        if self.names is not None and self.field not in Apartment.INTERNED:
+            raise ValueError("\"%s\" takes numbers, yes or no, not names: %s" % (self.field, text))
+
+    @staticmethod
+    def number(v):
+        try:
+            return float(str(v).replace(" ", ""))
+        except ValueError:
+            return None
+
+    def accepts(self, value):
+        if self.flag is not None:
+            return bool(value) == self.flag
+        if not value:
+            return True
+        if self.names is not None:
+            key = self.keys.get(value)
+            if key is None:
+                key = self.keys[value] = district_key(value)
+            found = any(key == n or key.startswith(n + " ") or n.startswith(key + " ") for n in self.names)
+            return not key or found != self.negate
+        v = self.number(value)
+        if v is None:
+            return True
+        if self.compare:
+            return self.compare[0](v, self.compare[1])
+        return any(low <= v <= high for low, high in self.ranges)
+
+
+class Filters:
+    """
+    The listing filters: a listing failing one isn't geocoded, scored nor reported. The filters of the fields final
+    once parsed (no rule overwrites them, e.g. rooms or district, not price) are checked while the page is being
+    parsed, the parsing stops at the first one failing.
+    """
+
+    # fields no rule overwrites and no parsing step changes afterwards
+    FINAL = set(r[0] for r in RULES) - set(r[0] for r in RULES if len(r) > 3 and r[3]) - \
+        set(('price', 'price_wo_vat', 'street', 'street_full'))
+
+    def __init__(self, filters):
+        self.filters = [Filter(f) for f in filters]
+        # a flag not found is "no" only once the whole page is parsed
+        self.early = [f for f in self.filters if f.field in self.FINAL and f.flag is not True]
+
+    def rejects(self, apartment, filters=None):
+        """The first of the filters (all by default) the apartment fails, None if it passes"""
+        for f in self.filters if filters is None else filters:
+            if not f.accepts(getattr(apartment, f.field)):
+                return f
+        return None
+
+
+def token_hashes(tokens):
+    return set(zlib.crc32(t.encode('utf-8')) & 0xffffffff for t in tokens)
+
+
+def minhash_params(n, seed=0):
+    rnd = random.Random(seed)
+    return [(rnd.randrange(1, MERSENNE), rnd.randrange(MERSENNE)) for _ in range(n)]
+
+
+MINHASH = minhash_params(SIGNATURE)
+
+
+def minhash(tokens):
+    """MinHash signature of the tokens: the min of every (a * h + b) mod MERSENNE function over their hashes"""
+    hashes = token_hashes(tokens) or {0}
+    return [min((a * h + b) % MERSENNE for h in hashes) for a, b in MINHASH]
+
+
+def sketch(tokens):
+    """Bottom-k sketch of the tokens: the SKETCH smallest of their hashes"""
+    return array(str('I'), sorted(token_hashes(tokens))[:SKETCH])
+
+
+def sketch_similarity(x, y):
+    """Jaccard similarity estimate of two bottom-k sketches"""
+    union = sorted(set(x) | set(y))[:SKETCH]
+    if not union:
+        return 0.0
+    both = set(x) & set(y)
+    return sum(1 for h in union if h in both) / float(len(union))
+
+
+def name_key(name):
+    """Words of a district or street name, lowercased and transliterated to latin, without numbers and tags"""
+    return " ".join(re.findall(r'[a-z]+', "".join(TRANSLIT.get(c, c) for c in reTag.sub(" ", name).lower())))
+
+
+def grid(name, value, step):
+    """Tokens of the value on two grids shifted by half a step, close values share at least one"""
+    return ["%s:%d" % (name, value // step), "%s+:%d" % (name, (value + step / 2.0) // step)]
+
+
+def shingles(lines, size=3):
+    """Word shingles of the text of the HTML lines"""
+    words = reWord.findall(reTag.sub(" ", " ".join(lines)).lower())
+    return set(" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1)))
+
+
+def same_listing(a, b):
+    """True if the apartments look like the same one: the known fields agree and, on the same website,
+    the texts and images are alike too"""
+    if not a.sqm or not b.sqm or abs(int(a.sqm) - int(b.sqm)) > max(1, max(int(a.sqm), int(b.sqm)) * 0.02):
+        return False
+    for attr in ('rooms', 'floor', 'floor_max'):
+        x, y = getattr(a, attr), getattr(b, attr)
+        if x and y and int(x) != int(y):
+            return False
+    if a.price and b.price and abs(a.price - b.price) > max(a.price, b.price) * 0.1:
+        return False
+    for attr in ('district', 'street'):
+        # a name may be cut short ("Ivan" for "Ivan Vazov")
+        x, y = set(name_key(getattr(a, attr)).split()), set(name_key(getattr(b, attr)).split())
+        if x and y and not (x <= y or y <= x):
+            return False
+    if site_of(a.url) is site_of(b.url):
+        return sketch_similarity(a.sketch, b.sketch) >= CONTENT_SIMILARITY
+    return True
+
+
+class Duplicates:
+    """
+    Near-duplicate listings: the same apartment on several websites or reposted by several agencies.
+    The apartments whose MinHash signatures of the fields share a band land in the same LSH bucket, so
+    an apartment is checked with same_listing() only against the few alike ones. The first apartment of a cluster is
+    its canonical entry, the later ones are merged into it.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.merged = set()
+
+    def canonical(self, apartment):
+        """The canonical apartment the apartment duplicates, None if it is a new one"""
+        signature = minhash(apartment.fieldTokens())
+        rows = SIGNATURE // BANDS
+        keys = [(n, tuple(signature[n * rows:(n + 1) * rows])) for n in range(BANDS)]
+        checked = set()
+        for key in keys:
+            for other in self.buckets.get(key, ()):
+                if other.id in checked:
+                    continue
+                checked.add(other.id)
+                if same_listing(apartment, other):
+                    self.merged.add(apartment.id)
+                    return other
+        for key in keys:
+            self.buckets.setdefault(key, []).append(apartment)
+        return None
+
+
+class HostLimits:
+    """Per host semaphores allowing at most host_jobs requests in flight to a host"""
+
+    def __init__(self, host_jobs):
+        self.host_jobs = host_jobs
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def __call__(self, url):
+        host = urlparse(url).netloc.lower()
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.host_jobs)
+            return self.semaphores[host]
+
+
+def in_order(pending, window):
+    """
+    Pop the (item, AsyncResult) pairs from the pending deque that are done, in their order, or the
+    first one anyway while more than window are pending. Waiting for them keeps the number of pages
+    in memory bounded however slow the next stage is.
+    """
+    while pending and (len(pending) > window or pending[0][1].ready()):
+        item, result = pending.popleft()
+        yield item, result.get()
+
+
+class Fetcher:
+    """
+    Fetches apartment pages in parallel, with at most host_jobs requests in flight per host and at most
+    2 * jobs fetched pages waiting for the parser
+    """
+
+    def __init__(self, jobs, limits, revalidate=False):
+        self.pool = ThreadPool(jobs)
+        self.window = 2 * jobs
+        self.limits = limits
+        self.revalidate = revalidate
+
+    def fetch(self, apartment):
+        with self.limits(apartment.url):
+            return apartment.getPage(self.revalidate)
+
+    def imap(self, apartments):
+        # results come back in the input order, so the ranking is the same as in a serial run
+        pending = deque()
+        for a in apartments:
+            pending.append((a, self.pool.apply_async(self.fetch, (a,))))
+            for page in in_order(pending, self.window):
+                yield page
+        for page in in_order(pending, 0):
+            yield page
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def parser_init():
+    # Ctrl-C stops the main process, it closes the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the figures forked from the main process are not the parser's
+    if PROFILE:
+        PROFILE.take()
+
+
+def parse_pages(pages, digests=False):
+    """Parser process: (digest if asked for, parsed fields) of the [(url, (page bytes, charset))] and the --profile
+    figures"""
+    parsed = []
+    for url, page in pages:
+        a = Apartment(0, url)
+        digest = a.scanPage(page, digests)
+        parsed.append((digest, a.values()))
+    return parsed, PROFILE.take() if PROFILE else None
+
+
+class Done:
+    """The AsyncResult of a value at hand"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+
+class Parser:
+    """
+    Decodes and parses the fetched pages in jobs processes, so the rules run on all the cores. The pages
+    go to the processes as downloaded, BATCH at a time, the main process only looks the pages up in the
+    parsed listings store, the processes have none, and stores the parsed fields. At most 2 * jobs
+    batches are parsed or wait for a process at once. The apartments come out in the order of the pages.
+    """
+
+    BATCH = 8
+
+    def __init__(self, jobs):
+        self.pool = multiprocessing.Pool(jobs, parser_init)
+        self.window = 2 * jobs
+
+    def imap(self, pages, digests=False):
+        """(apartment, page digest if asked for or stored) of the (apartment, (page bytes, charset)) once parsed"""
+        # the parser processes have no parsed listings store
+        digests = digests or LISTINGS is not None
+        pending = deque()
+        batch = []
+        for a, page in pages:
+            # the digest of a stored page, None for a page to parse
+            batch.append((a, page, a.loadPage(page) if LISTINGS else None))
+            if len(batch) >= self.BATCH:
+                pending.append(self.submit(batch, digests))
+                batch = []
+            for parsed in self.parsed(pending, self.window):
+                yield parsed
+        if batch:
+            pending.append(self.submit(batch, digests))
+        for parsed in self.parsed(pending, 0):
+            yield parsed
+
+    def submit(self, batch, digests):
+        pages = [(a.url, page) for a, page, stored in batch if stored is None]
+        result = self.pool.apply_async(parse_pages, (pages, digests)) if pages else Done(([], None))
+        return [(a, stored) for a, _, stored in batch], result
+
+    def parsed(self, pending, window):
+        for apartments, (parsed, figures) in in_order(pending, window):
+            if figures:
+                PROFILE.merge(figures)
+            parsed = iter(parsed)
+            for a, digest in apartments:
+                if digest is None:
+                    digest, values = next(parsed)
+                    a.update(dict(zip(a.PARSED, values)))
+                    a.save(digest)
+                yield a, digest
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class Crawler:
+    """
+    Collects the apartment links from the search pages in a background thread, following the
+    pagination of every search for up to depth pages. Up to jobs pages are fetched at once, the
+    links come out in the order of a serial crawl and only once. A search ends at a page without
+    links or with the links of the page before, or, polling, at the first page without new links.
+    The crawl ends after limit links. Once the links are all taken, complete tells if the crawl
+    found all the listings of the searches: no page failed and no limit cut it short.
+    """
+
+    def __init__(self, searches, depth=1, limit=None, jobs=1, limits=None, seen=(), polling=False):
+        self.searches = searches
+        self.depth = depth
+        self.limit = limit
+        self.jobs = jobs
+        self.limits = limits or HostLimits(jobs)
+        self.pool = ThreadPool(jobs)
+        self.seen = set(seen)
+        self.polling = polling
+        self.ended = set()
+        # the links of the last page of every search
+        self.last = {}
+        self.complete = True
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __iter__(self):
+        while True:
+            link = self.queue.get()
+            if link is None:
+                return
+            yield link
+
+    def pages(self):
+        """(search number, page number, url) of the search pages in the crawl order"""
+        for n, url in enumerate(self.searches):
+            site = site_of(url)
+            for page in range(self.depth):
+                if not url or n in self.ended:
+                    break
+                yield n, page, url
+                url = site.nextPage(url)
+
+    def fetch(self, url):
+        with self.limits(url), Stage('crawl'):
+            logging.info("open apartments search page list: %s" % url)
+            response = url_open(url)
+            return page_lines(response.read(), charset_of(response.headers.get('Content-Type')), site_of(url))
+
+    def run(self):
+        pages = self.pages()
+        pending = deque()
+        found = 0
+        try:
+            while True:
+                for n, page, url in pages:
+                    pending.append((n, page, url, self.pool.apply_async(self.fetch, (url,))))
+                    if len(pending) >= self.jobs:
+                        break
+                if not pending:
+                    return
+
+                n, page, url, result = pending.popleft()
+                if n in self.ended:
+                    continue
+                try:
+                    lines = result.get()
+                except (IOError, HTTPException) as e:
+                    logging.warning("can't fetch: %s - %s" % (url, str(e)))
+                    lines = []
+                    self.complete = False
+
+                new = 0
+                links = []
+                site = site_of(url)
+                for l in lines:
+                    for r in site.links:
+                        m = r.search(l)
+                        if not m:
+                            continue
+                        link = m.group(1)
+                        if not link.startswith("http"):
+                            link = "http://" + link
+                        links.append(link)
+                        if link in self.seen:
+                            continue
+                        self.seen.add(link)
+                        logging.debug("  found apartment link: %s" % link)
+                        self.queue.put(link)
+                        new += 1
+                        found += 1
+                        if self.limit and found >= self.limit:
+                            self.complete = False
+                            return
+                if not links or links == self.last.get(n):
+                    # past the last page
+                    self.ended.add(n)
+                elif self.polling and not new:
+                    # a poll ends at the listings it has seen, those after them weren't looked at
+                    self.ended.add(n)
+                    self.complete = False
+                elif page == self.depth - 1 and site.nextPage(url):
+                    # the search goes on beyond --depth
+                    self.complete = False
+                self.last[n] = links
+        except Exception:
+            # the searches not crawled to the end
+            self.complete = False
+            raise
+        finally:
+            self.pool.close()
+            self.queue.put(None)
+
+
+class PollSchedule:
+    """
+    When to poll the searches of every website again in --watch mode. The interval of a website follows
+    the rate its new listings appear at (a moving average of the new listings per second) so that a poll
+    finds about one new listing, within SPAN times of the --watch interval either way.
+    """
+
+    SPAN = 4.0
+    WEIGHT = 0.3
+
+    def __init__(self, hosts, interval, now):
+        self.interval = interval
+        self.rates = {}
+        self.polled = dict((host, now) for host in hosts)
+        self.next = dict((host, now + interval) for host in hosts)
+
+    def due(self, now):
+        return sorted(host for host, at in self.next.items() if at <= now)
+
+    def wait(self, now):
+        """Seconds till the next poll"""
+        return max(0.0, min(self.next.values()) - now)
+
+    def update(self, host, new, now):
+        """Schedule the next poll of the website after its poll started at now found new listings, returns the
+        interval"""
+        rate = float(new) / max(now - self.polled[host], 1.0)
+        self.polled[host] = now
+        if host in self.rates:
+            rate = self.WEIGHT * rate + (1 - self.WEIGHT) * self.rates[host]
+        self.rates[host] = rate
+        interval = 1.0 / rate if rate else self.interval * self.SPAN
+        interval = min(max(interval, self.interval / self.SPAN), self.interval * self.SPAN)
+        self.next[host] = now + interval
+        return interval
+
+
+class CacheEntry:
+    def __init__(self, data, fresh, etag, last_modified, charset):
+        self.data = data
+        self.fresh = fresh
+        self.etag = etag
+        self.last_modified = last_modified
+        self.charset = charset
+
+
+class PageCache:
+    """
+    Pages cache: a single SQLite file with zlib-compressed pages, as downloaded, and their charsets.
+    Entries older than ttl seconds are revalidated with a conditional GET (ETag / Last-Modified),
+    the least recently used ones are evicted when the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, path, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, data BLOB, size INTEGER, "
+                        "fetched REAL, accessed REAL, etag TEXT, last_modified TEXT, charset TEXT)")
+        if 'charset' not in [column[1] for column in self.db.execute("PRAGMA table_info(pages)")]:
+            # the caches of the previous versions, their pages are decoded with the charsets of <meta> tags
+            self.db.execute("ALTER TABLE pages ADD COLUMN charset TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)")
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT data, fetched, etag, last_modified, charset FROM pages WHERE url = ?",
+                                  (url,)).fetchone()
+            if not row:
+                return None
+            self.db.execute("UPDATE pages SET accessed = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+        data, fetched, etag, last_modified, charset = row
+        fresh = not self.ttl or time.time() - fetched < self.ttl
+        return CacheEntry(zlib.decompress(bytes(data)), fresh, etag, last_modified, charset)
+
+    def put(self, url, data, etag=None, last_modified=None, charset=None):
+        blob = zlib.compress(data)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+            self.size += len(blob) - (row[0] if row else 0)
+            self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (url, sqlite3.Binary(blob), len(blob), now, now, etag, last_modified, charset))
+            self.evict()
+            self.db.commit()
+
+    def revalidated(self, url):
+        """The server says the cached page is not modified"""
+        with self.lock:
+            self.db.execute("UPDATE pages SET fetched = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+
+    def evict(self):
+        if not self.max_size or self.size <= self.max_size:
+            return
+        # other processes sharing the cache (--watch and a cron run) add and evict pages too
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        while self.size > self.max_size:
+            rows = self.db.execute("SELECT url, size FROM pages ORDER BY accessed LIMIT 100").fetchall()
+            if not rows:
+                return
+            for url, size in rows:
+                self.db.execute("DELETE FROM pages WHERE url = ?", (url,))
+                self.size -= size
+                if self.size <= self.max_size * 0.9:
+                    return
+
+
+class GeoCache:
+    """
+    Geocoding cache: address -> (lat, lon), or None for the addresses the geocoder can't find.
+    Coordinates don't depend on the distance target, so a new -d costs no geocoding at all.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS geocodes (address TEXT PRIMARY KEY, lat REAL, lon REAL, "
+                        "updated REAL)")
+        self.points = {}
+        # the addresses the gazetteer found
+        self.located = set()
+        for address, lat, lon in self.db.execute("SELECT address, lat, lon FROM geocodes"):
+            self.points[address] = None if lat is None else (lat, lon)
+
+    @staticmethod
+    def key(address):
+        return address if isinstance(address, type(u"")) else address.decode('utf-8')
+
+    def __contains__(self, address):
+        return self.key(address) in self.points
+
+    def get(self, address):
+        return self.points[self.key(address)]
+
+    def put(self, address, point):
+        address = self.key(address)
+        with self.lock:
+            self.points[address] = point
+            self.db.execute("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)",
+                            (address, point[0] if point else None, point[1] if point else None, time.time()))
+            self.db.commit()
+
+    def locate(self, address, point):
+        """Coordinates of the address found offline, kept in memory only"""
+        with self.lock:
+            self.points[self.key(address)] = point
+            self.located.add(self.key(address))
+
+    def offline(self, address):
+        """True if the address was found offline"""
+        return self.key(address) in self.located
+
+    def lookup(self, address):
+        """Cached coordinates of the address, None if it can't be found or isn't geocoded yet"""
+        count('geocodes.hit' if address in self else 'geocodes.miss')
+        return self.points.get(self.key(address))
+
+    def geocode(self, geolocator, address):
+        """Cached coordinates of the address, None if it can't be found, geocoder errors are passed on"""
+        if address in self:
+            return self.get(address)
+        logging.debug("  geocoding: %s" % address)
+        with Stage('geocode'):
+            location = geolocator.geocode(address, language="bg-BG", timeout=15)
+        point = (location.latitude, location.longitude) if location else None
+        self.put(address, point)
+        return point
+
+
+def place_words(name):
+    """Words of a place name, lowercased and transliterated to latin, without tags and type words"""
+    words = re.findall(r'[a-z0-9]+', "".join(TRANSLIT.get(c, c) for c in reTag.sub(" ", name).lower()))
+    while words and words[0] in PLACE_TYPES:
+        words = words[1:]
+    return words
+
+
+def street_key(name):
+    """Gazetteer key of a street name: its words up to the house number"""
+    words = place_words(name)
+    for i, word in enumerate(words):
+        if i and (word[0].isdigit() or word in HOUSE_WORDS):
+            return " ".join(words[:i])
+    return " ".join(words)
+
+
+def district_key(name):
+    return " ".join(place_words(name))
+
+
+class Gazetteer:
+    """
+    Offline geocoder of the --gazetteer file, a "city,district,street,lat,lon" line per street (a street in
+    several districts has a line for each) or per district (no street), e.g. converted once from an OSM extract.
+
+    The names are looked up transliterated and without the type words and house numbers in tries, which also
+    find the names a few typos away and the longer names starting with the words looked up (e.g. ""
+    for " "). A street in several districts is found in the district of the listing only.
+    """
+
+    def __init__(self, path):
+        self.cities = {}
+        # city key -> trie of the street keys -> [(district key, (lat, lon))]
+        self.streets = {}
+        # city key -> trie of the district keys -> (district key, (lat, lon) or None)
+        self.districts = {}
+        self.found = {}
+        with io.open(path, encoding='utf-8') as f:
+            for n, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                fields = line.split(",")
+                try:
+                    point = (float(fields[3]), float(fields[4]))
+                except (IndexError, ValueError):
+                    if n == 1:
+                        # the header
+                        continue
+                    raise ValueError("%s:%d: not a \"city,district,street,lat,lon\" line: %s" % (path, n, line))
+                city, district, street = district_key(fields[0]), district_key(fields[1]), street_key(fields[2])
+                if not city or not (district or street):
+                    raise ValueError("%s:%d: no city or no district and street: %s" % (path, n, line))
+                self.node(self.cities, city)[None] = city
+                if district:
+                    node = self.node(self.districts.setdefault(city, {}), district)
+                    if node.get(None, (None, None))[1] is None:
+                        node[None] = (district, None if street else point)
+                if street:
+                    self.node(self.streets.setdefault(city, {}), street).setdefault(None, []).append((district, point))
+
+    @staticmethod
+    def node(trie, key):
+        for c in key:
+            trie = trie.setdefault(c, {})
+        return trie
+
+    @staticmethod
+    def find(trie, key):
+        """
+        Values of the trie key, else of the keys closest to it (1 edit away for 4+ letters, 2 for 8+), else of
+        the keys starting with its words; [] if none
+        """
+        node = trie
+        for c in key:
+            node = node.get(c)
+            if node is None:
+                break
+        else:
+            if None in node:
+                return [node[None]]
+
+        # 1 edit away first, the search of 2 edits visits many more nodes
+        for limit in range(1, 1 + (0 if len(key) < 4 else 1 if len(key) < 8 else 2)):
+            found = {}
+            # Levenshtein distances of the key to the prefixes the trie nodes stand for, a row per node
+            stack = [(trie, list(range(len(key) + 1)))]
+            while stack:
+                parent, row = stack.pop()
+                if None in parent and row[-1] <= limit:
+                    found.setdefault(row[-1], []).append(parent[None])
+                if min(row) > limit:
+                    continue
+                for c, child in parent.items():
+                    if c is None:
+                        continue
+                    new = [row[0] + 1]
+                    for i, k in enumerate(key):
+                        new.append(min(new[i] + 1, row[i + 1] + 1, row[i] + (k != c)))
+                    stack.append((child, new))
+            if found:
+                return found[min(found)]
+
+        found = []
+        stack = [node[" "]] if node is not None and " " in node else []
+        while stack:
+            parent = stack.pop()
+            stack.extend(child for c, child in parent.items() if c is not None)
+            if None in parent:
+                found.append(parent[None])
+        return found
+
+    def locate(self, city, district, street):
+        """(lat, lon) of the street (of the district if there is no street), None if it isn't found"""
+        query = (city, district, street)
+        if query not in self.found:
+            self.found[query] = self.search(district_key(city), district_key(district), street_key(street))
+        return self.found[query]
+
+    def search(self, city, district, street):
+        cities = self.find(self.cities, city) if city else []
+        if not cities:
+            return None
+        city = cities[0]
+
+        districts = self.find(self.districts.get(city, {}), district) if district else []
+        if not street:
+            points = set(point for _, point in districts if point is not None)
+            return points.pop() if len(points) == 1 else None
+
+        entries = [e for found in self.find(self.streets.get(city, {}), street) for e in found]
+        if len(entries) == 1:
+            return entries[0][1]
+        keys = set(key for key, _ in districts)
+        points = set(point for key, point in entries if key in keys)
+        return points.pop() if len(points) == 1 else None
+
+
+class ListingStore:
+    """
+    Parsed listings: url -> Apartment fields extracted from the page with the given content digest.
+    Records of other parser versions (see parser_version()) are dropped on open, so the pages are
+    parsed again after any change of the rules or the parser.
+    """
+
+    def __init__(self, path, version):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS listings (url TEXT PRIMARY KEY, digest TEXT, version TEXT, "
+                        "fields BLOB, updated REAL)")
+        self.db.execute("DELETE FROM listings WHERE version != ?", (version,))
+        self.db.commit()
+        self.version = version
+
+    def has(self, url):
+        """True if fields of the url are stored, of any page"""
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM listings WHERE url = ?", (url,)).fetchone() is not None
+
+    def get(self, url, digest):
+        """Stored fields of the page, None if the page is new or changed"""
+        with self.lock:
+            row = self.db.execute("SELECT fields FROM listings WHERE url = ? AND digest = ?",
+                                  (url, digest)).fetchone()
+        return pickle.loads(bytes(row[0])) if row else None
+
+    def put(self, url, digest, fields):
+        blob = pickle.dumps(fields, 2)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)",
+                            (url, digest, self.version, sqlite3.Binary(blob), time.time()))
+            self.db.commit()
+
+
+def text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def page_digest(data):
+    return text_digest("\n".join(data))
+
+
+def parser_version():
+    """Digest of the scanner source"""
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class Manifest:
+    """
+    Listings of the previous --delta runs: url -> first and last seen times, the last time the page
+    was fetched, the price and the page digest. Only the new listings and a rotating sample of the
+    known ones (the recheck share checked longest ago) are fetched again.
+    """
+
+    def __init__(self, path, recheck):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS manifest (url TEXT PRIMARY KEY, first_seen REAL, last_seen REAL, "
+                        "checked REAL, price REAL, digest TEXT, removed REAL)")
+        self.started = time.time()
+        self.known = {}
+        for url, price, digest in self.db.execute("SELECT url, price, digest FROM manifest WHERE removed IS NULL"):
+            self.known[url] = (price, digest)
+        rows = self.db.execute("SELECT url FROM manifest WHERE removed IS NULL ORDER BY checked LIMIT ?",
+                               (int(math.ceil(len(self.known) * recheck)),))
+        self.sample = set(row[0] for row in rows)
+        self.seen = set()
+
+    def due(self, url):
+        """True if the listing found in this run has to be fetched"""
+        self.seen.add(url)
+        return url not in self.known or url in self.sample
+
+    def update(self, url, price, digest):
+        """Record a fetched listing, returns (change, previous price), the change is "new", "repriced" or None"""
+        if url not in self.known:
+            self.db.execute("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, NULL)",
+                            (url, self.started, self.started, self.started, price, digest))
+            return "new", None
+
+        old_price, old_digest = self.known[url]
+        # zero is a price that couldn't be parsed
+        repriced = digest != old_digest and price and old_price and price != old_price
+        self.db.execute("UPDATE manifest SET checked = ?, price = ?, digest = ? WHERE url = ?",
+                        (self.started, price or old_price, digest, url))
+        return "repriced" if repriced else None, old_price
+
+    def skipped(self):
+        """[(url, price)] of the known listings found in this run but not fetched"""
+        return sorted((url, self.known[url][0]) for url in self.seen if url in self.known and url not in self.sample)
+
+    def removed(self):
+        """[(url, price)] of the known listings not found in this run, they are marked removed"""
+        gone = sorted((url, price) for url, (price, _) in self.known.items() if url not in self.seen)
+        self.db.executemany("UPDATE manifest SET removed = ? WHERE url = ?", [(self.started, url) for url, _ in gone])
+        return gone
+
+    def save(self):
+        self.db.executemany("UPDATE manifest SET last_seen = ? WHERE url = ?",
+                            [(self.started, url) for url in self.seen])
+        self.db.commit()
+
+
+class History:
+    """
+    Price history of the --history directory: a row per listing per run, stored by column. Every column is a
+    file of fixed-size values (array typecodes) appended at the end of a run and memory-mapped by the queries.
+    The URL and district columns are dictionary-encoded: they hold line numbers of url.txt and district.txt,
+    the districts transliterated (see district_key()), so the websites' spellings are one district.
+    The rows are in time order.
+    """
+
+    COLUMNS = (('time', 'd'), ('url', 'i'), ('district', 'i'), ('price', 'd'), ('price_wo_vat', 'd'),
+               ('sqm', 'f'), ('rooms', 'f'), ('floor', 'f'), ('distance', 'f'), ('score', 'f'))
+    DICTIONARIES = ('url', 'district')
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.values = {}
+        self.codes = {}
+        for column in self.DICTIONARIES:
+            name = os.path.join(path, '%s.txt' % column)
+            values = []
+            if os.path.exists(name):
+                with io.open(name, encoding='utf-8') as f:
+                    values = f.read().split("\n")[:-1]
+            self.values[column] = values
+            self.codes[column] = dict((v, n) for n, v in enumerate(values))
+
+        # a run stopped while appending leaves some columns longer, their rows are dropped
+        self.rows = min(self.size(column, typecode) for column, typecode in self.COLUMNS)
+        for column, typecode in self.COLUMNS:
+            if self.size(column, typecode) > self.rows:
+                with open(self.file(column, typecode), 'r+b') as f:
+                    f.truncate(self.rows * array(str(typecode)).itemsize)
+
+    def file(self, column, typecode):
+        return os.path.join(self.path, '%s.%s' % (column, typecode))
+
+    def size(self, column, typecode):
+        name = self.file(column, typecode)
+        return os.path.getsize(name) // array(str(typecode)).itemsize if os.path.exists(name) else 0
+
+    def code(self, column, value):
+        codes = self.codes[column]
+        if value not in codes:
+            codes[value] = len(self.values[column])
+            self.values[column].append(value)
+            with io.open(os.path.join(self.path, '%s.txt' % column), 'a', encoding='utf-8') as f:
+                f.write(value + "\n")
+        return codes[value]
+
+    def append(self, apartments, ranked=None, when=None):
+        """Add a row per apartment, the scores of the first ranking (NaN for the apartments not in it)"""
+        scores = dict((a.id, score) for score, a in ranked[0][1]) if ranked else {}
+        when = time.time() if when is None else when
+        nan = float('nan')
+
+        def number(v):
+            v = Filter.number(v) if v else None
+            return nan if v is None else v
+
+        columns = dict((column, array(str(typecode))) for column, typecode in self.COLUMNS)
+        for a in apartments:
+            columns['time'].append(when)
+            columns['url'].append(self.code('url', a.url))
+            columns['district'].append(self.code('district', district_key(a.district)))
+            for column in ('price', 'price_wo_vat', 'sqm', 'rooms', 'floor', 'distance'):
+                columns[column].append(number(getattr(a, column)))
+            columns['score'].append(float(scores.get(a.id, nan)))
+        for column, typecode in self.COLUMNS:
+            with open(self.file(column, typecode), 'ab') as f:
+                columns[column].tofile(f)
+        self.rows += len(apartments)
+
+    def carried(self, listings):
+        """
+        Apartments of the [(url, price)] listings a --delta run found but didn't fetch, with the fields of their
+        last row but the price, so the run has a row for them too and they aren't taken for gone
+        """
+        codes = self.codes['url']
+        wanted = set(codes[url] for url, _ in listings if url in codes)
+        last = {}
+        if wanted:
+            urls = array(str('i'))
+            with open(self.file('url', 'i'), 'rb') as f:
+                urls.fromfile(f, self.rows)
+            # the listings of a delta run are mostly in the last rows
+            for i in range(self.rows - 1, -1, -1):
+                if urls[i] in wanted and urls[i] not in last:
+                    last[urls[i]] = i
+                    if len(last) == len(wanted):
+                        break
+
+        apartments = []
+        for url, price in listings:
+            a = Apartment(0, url)
+            row = last.get(codes.get(url))
+            if row is not None:
+                a.district = self.values['district'][self.read('district', 'i', row)]
+                for column in ('price_wo_vat', 'sqm', 'rooms', 'floor', 'distance'):
+                    setattr(a, column, self.read(column, dict(self.COLUMNS)[column], row))
+            a.price = price
+            apartments.append(a)
+        return apartments
+
+    def read(self, column, typecode, row):
+        values = array(str(typecode))
+        with open(self.file(column, typecode), 'rb') as f:
+            f.seek(row * values.itemsize)
+            values.fromfile(f, 1)
+        return values[0]
+
+    def load(self):
+        """{column: numpy array} of all the rows, memory-mapped"""
+        columns = {}
+        for column, typecode in self.COLUMNS:
+            if self.rows:
+                columns[column] = numpy.memmap(self.file(column, typecode), dtype=typecode, mode='r',
+                                               shape=(self.rows,))
+            else:
+                columns[column] = numpy.zeros(0, dtype=typecode)
+        return columns
+
+
+def sort_groups(groups, values=None):
+    """
+    Order of the rows by their groups, non-negative integers, then by their non-negative values or, without
+    values, by row. One argsort of a combined key: quicksort, so much faster than lexsort or a stable sort
+    """
+    if values is None:
+        key = groups.astype(numpy.int64) * len(groups) + numpy.arange(len(groups))
+    else:
+        key = groups * (values.max() + 1 if len(values) else 1) + values
+    return numpy.argsort(key)
+
+
+def group_starts(keys):
+    """Start indexes of the runs of equal sorted keys"""
+    return numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]]) if len(keys) else numpy.zeros(0, dtype=int)
+
+
+def group_ends(starts, n):
+    """End indexes, inclusive, of the runs starting at the starts"""
+    return numpy.r_[starts[1:], n] - 1 if len(starts) else starts
+
+
+def medians(values, starts):
+    """Medians of the runs of sorted values starting at the starts"""
+    ends = group_ends(starts, len(values))
+    return (values[(starts + ends) // 2] + values[(starts + ends + 1) // 2]) / 2
+
+
+def period_days(times, period):
+    """First day (since the epoch, UTC) of the day, week (from Monday) or month of the times"""
+    days = (times // 86400).astype(numpy.int64)
+    if period == 'week':
+        # the epoch is a Thursday
+        return days - (days + 3) % 7
+    if period == 'month':
+        return days.astype('datetime64[D]').astype('datetime64[M]').astype('datetime64[D]').astype(numpy.int64)
+    return days
+
+
+def day_name(days):
+    return str(numpy.datetime64(int(days), 'D'))
+
+
+def history_query(history, query, period='week', top=None):
+    """(header, rows) of a --query of the history, computed on the columns without a Python object per row"""
+    c = history.load()
+    t, url, district, price = c['time'], c['url'], c['district'], c['price']
+    districts = history.values['district']
+
+    if query == 'eur_sqm':
+        # the last price of a listing in a period, the rows are in time order
+        days = period_days(t, period)
+        runs = group_starts(t)
+        if len(numpy.unique(days[runs])) == len(runs):
+            # a run per period, e.g. daily runs by day: a row per listing already
+            last = numpy.arange(len(t))
+        else:
+            first = days.min()
+            key = url.astype(numpy.int64) * (days.max() - first + 1) + (days - first)
+            order = sort_groups(key)
+            last = order[group_ends(group_starts(key[order]), len(order))]
+        last = last[(price[last] > 0) & (c['sqm'][last] > 0)]
+        eur = price[last] / c['sqm'][last]
+        key = days[last] * len(districts) + district[last]
+        order = sort_groups(key - (key.min() if len(key) else 0), eur)
+        starts = group_starts(key[order])
+        values = medians(eur[order], starts)
+        counts = numpy.diff(numpy.r_[starts, len(order)])
+        rows = [(day_name(k // len(districts)), districts[k % len(districts)], n, "%.0f" % v)
+                for k, n, v in zip(key[order][starts], counts, values)]
+        return (period, 'district', 'listings', 'median_eur_sqm'), rows
+
+    if query == 'market':
+        # the first and the last row of every listing
+        order = sort_groups(url)
+        starts = group_starts(url[order])
+        first, last = order[starts], order[group_ends(starts, len(order))]
+        days = (t[last] - t[first]) / 86400
+        # not seen for a day before the last run: gone
+        gone = t[last] < (t.max() if len(t) else 0) - 86400
+        order = sort_groups(district[last], days)
+        starts = group_starts(district[last][order])
+        counts = numpy.diff(numpy.r_[starts, len(order)])
+        values = medians(days[order], starts)
+        gone = numpy.add.reduceat(gone[order], starts) if len(starts) else starts
+        rows = [(districts[d], n, g, "%.1f" % v)
+                for d, n, g, v in zip(district[last][order][starts], counts, gone, values)]
+        return ('district', 'listings', 'gone', 'median_days_listed'), rows
+
+    if query == 'drops':
+        # the first and the last known price of every listing
+        priced = numpy.flatnonzero(price > 0)
+        order = priced[sort_groups(url[priced])]
+        starts = group_starts(url[order])
+        first, last = order[starts], order[group_ends(starts, len(order))]
+        change = price[last] / price[first] - 1
+        dropped = numpy.flatnonzero(change < 0)
+        dropped = dropped[numpy.argsort(change[dropped], kind='mergesort')][:top or 20]
+        rows = [(history.values['url'][url[last[i]]], districts[district[last[i]]], day_name(t[first[i]] // 86400),
+                 "%.0f" % price[first[i]], "%.0f" % price[last[i]], "%.1f%%" % (change[i] * 100)) for i in dropped]
+        return ('url', 'district', 'since', 'first_price', 'last_price', 'change'), rows
+
+    raise ValueError("unknown history query: %s" % query)
+
+
+class TokenBucket:
+    """Rate limiter: rate requests per second with bursts of up to burst requests"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+class GeocodeScheduler:
+    """
+    Geocodes the addresses of the apartments in a background thread while the pages are still being
+    fetched and parsed. Every address is geocoded once for all the apartments, requests go through
+    a token bucket (Nominatim allows 1 request per second), timed out and over-quota requests are
+    put back to the queue and retried later. An address failing otherwise is logged and left out.
+    """
+
+    RETRIES = 5
+
+    def __init__(self, geolocator, rate=1.0, gazetteer=None):
+        self.geolocator = geolocator
+        self.gazetteer = gazetteer
+        self.bucket = TokenBucket(rate)
+        self.queue = Queue()
+        self.seen = set()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def geocode(self, address):
+        """Geocode the address right away, in the rate limit"""
+        if address not in GEOCODES:
+            self.bucket.acquire()
+        return GEOCODES.geocode(self.geolocator, address)
+
+    def submit(self, apartment, lazy=False):
+        """
+        Queue the addresses of the apartment not geocoded yet, returns their number. A lazy submit only counts
+        them, the gazetteer points are taken anyway.
+        """
+        addresses = apartment.getAddresses() or []
+        if self.gazetteer and addresses:
+            with Stage('gazetteer'):
+                point = self.gazetteer.locate(apartment.city, apartment.district, apartment.street)
+            if point or not lazy:
+                count('gazetteer.hit' if point else 'gazetteer.miss')
+            if point:
+                GEOCODES.locate(addresses[0], point)
+                return 0
+        missing = 0
+        for address in addresses:
+            if address in self.seen or address in GEOCODES:
+                continue
+            missing += 1
+            if not lazy:
+                self.seen.add(address)
+                self.queue.put((address, 0))
+        return missing
+
+    def run(self):
+        while True:
+            address, attempt = self.queue.get()
+            try:
+                self.bucket.acquire()
+                GEOCODES.geocode(self.geolocator, address)
+            except (GeocoderTimedOut, GeocoderQuotaExceeded) as e:
+                if attempt + 1 < self.RETRIES:
+                    logging.debug("  geocoding later (%s): %s" % (type(e).__name__, address))
+                    self.queue.put((address, attempt + 1))
+                else:
+                    logging.warning("can't geocode: %s - %s" % (address, str(e)))
+                if isinstance(e, GeocoderQuotaExceeded):
+                    time.sleep(2.0 ** attempt)
+            except GeopyError as e:
+                logging.warning("can't geocode: %s - %s" % (address, str(e)))
+            except Exception as e:
+                # e.g. a geocoding cache error or a malformed answer: the thread has to go on, join() waits for it
+                logging.warning("can't geocode: %s - %s: %s" % (address, type(e).__name__, e), exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """Wait for all the submitted addresses, retries included"""
+        self.queue.join()
+
+
+def distance_km(location, point):
+    km = DISTANCES.get((location, point))
+    count('distances.hit' if km is not None else 'distances.miss')
+    if km is None:
+        km = DISTANCES[(location, point)] = float(distance.distance(location, point).km)
+    return km
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distances between numpy arrays of coordinates in radians, broadcast"""
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+class Pois:
+    """
+    Points of interest of the --poi file, a "kind,lat,lon[,name]" line per point, e.g.
+    "metro,42.6977,23.3219,Serdika". Every kind gives two features: "<kind>_km" and "<kind>_500m".
+
+    The points are put on a grid of POI_CELL_KM square cells (an equirectangular projection around
+    them, fine for a city), the apartments of a cell are measured with vectorized haversine only
+    against the points of the cells that can hold their nearest point or the points within
+    POI_RADIUS_KM.
+    """
+
+    def __init__(self, path):
+        points = OrderedDict()
+        with io.open(path, encoding='utf-8') as f:
+            for n, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                fields = line.split(",")
+                try:
+                    point = (float(fields[1]), float(fields[2]))
+                except (IndexError, ValueError):
+                    if n == 1:
+                        # the header
+                        continue
+                    raise ValueError("%s:%d: not a \"kind,lat,lon[,name]\" line: %s" % (path, n, line))
+                kind = re.sub(r'\W+', '_', fields[0].strip().lower())
+                points.setdefault(kind, []).append(point)
+
+        self.points = OrderedDict((kind, numpy.radians(numpy.array(p))) for kind, p in points.items())
+        self.features = ()
+        for kind in self.points:
+            self.features += ("%s_km" % kind, "%s_%dm" % (kind, POI_RADIUS_KM * 1000))
+        if self.points:
+            self.origin = numpy.concatenate(list(self.points.values()))[:, 0].mean()
+        self.cells = dict((kind, self.cell(p)) for kind, p in self.points.items())
+
+    def cell(self, coords):
+        """Grid cells (row, column) of the [(lat, lon)] in radians"""
+        x = coords[:, 1] * numpy.cos(self.origin) * EARTH_KM
+        y = coords[:, 0] * EARTH_KM
+        return numpy.floor(numpy.column_stack((y, x)) / POI_CELL_KM).astype(int)
+
+    def values(self, poi):
+        """Scored values of the features, poi is None for an apartment without coordinates"""
+        if poi is None:
+            return [SCORE_DEFAULTS['distance'] if f.endswith("_km") else 0.0 for f in self.features]
+        return [poi[f] for f in self.features]
+
+    def measure(self, apartments):
+        """Set the features of the geocoded apartments"""
+        located = [(a, a.getPoint()) for a in apartments]
+        located = [(a, point) for a, point in located if point is not None]
+        if not located or not self.points:
+            return
+        coords = numpy.radians(numpy.array([point for _, point in located]))
+
+        # the apartments grouped by cell
+        cells, inverse = numpy.unique(self.cell(coords), axis=0, return_inverse=True)
+        order = numpy.argsort(inverse, kind='mergesort')
+        groups = numpy.split(order, numpy.cumsum(numpy.bincount(inverse))[:-1])
+
+        features = []
+        radius_cells = int(math.ceil(POI_RADIUS_KM / POI_CELL_KM)) + 1
+        for kind, points in self.points.items():
+            nearest = numpy.empty(len(located))
+            within = numpy.zeros(len(located), dtype=int)
+            for (row, column), rows in zip(cells, groups):
+                # Chebyshev distance in cells from the apartments cell to the points
+                steps = numpy.maximum(abs(self.cells[kind][:, 0] - row), abs(self.cells[kind][:, 1] - column))
+                # the nearest point of any apartment of the cell is within (r + 1) * sqrt(2) cells
+                # of it if the nearest cell with a point is r cells away
+                reach = max(int((steps.min() + 1) * math.sqrt(2)) + 1, radius_cells)
+                near = points[steps <= reach]
+                km = haversine_km(coords[rows, 0][:, None], coords[rows, 1][:, None], near[:, 0], near[:, 1])
+                nearest[rows] = km.min(axis=1)
+                within[rows] = (km <= POI_RADIUS_KM).sum(axis=1)
+            features += [nearest, within]
+
+        for i, (a, _) in enumerate(located):
+            a.poi = dict((f, float(values[i])) for f, values in zip(self.features, features))
+
+
+class Profile:
+    """
+    --profile figures: wall time and calls of the stages (summed over the threads), calls, hits and
+    time of every extraction rule, and the cache counters ("<cache>.hit", "<cache>.miss", ...).
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.rules = {}
+        self.counters = {}
+
+    def add(self, name, seconds):
+        with self.lock:
+            calls, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (calls + 1, total + seconds)
+
+    def rule(self, name, hit, seconds):
+        calls, hits, total = self.rules.get(name, (0, 0, 0.0))
+        self.rules[name] = (calls + 1, hits + hit, total + seconds)
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + 1
+
+    def take(self):
+        """The figures since the previous take(), they are reset"""
+        with self.lock:
+            figures = self.stages, self.rules, self.counters
+            self.stages, self.rules, self.counters = {}, {}, {}
+        return figures
+
+    def merge(self, figures):
+        """Add the figures taken from another process"""
+        stages, rules, counters = figures
+        with self.lock:
+            for name, (calls, total) in stages.items():
+                old_calls, old_total = self.stages.get(name, (0, 0.0))
+                self.stages[name] = (old_calls + calls, old_total + total)
+            for name, (calls, hits, total) in rules.items():
+                old_calls, old_hits, old_total = self.rules.get(name, (0, 0, 0.0))
+                self.rules[name] = (old_calls + calls, old_hits + hits, old_total + total)
+            for counter, n in counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def summary(self):
+        stages = dict((name, {'calls': calls, 'seconds': round(total, 4)})
+                      for name, (calls, total) in self.stages.items())
+        rules = [{'rule': name, 'calls': calls, 'hits': hits, 'seconds': round(total, 4)}
+                 for name, (calls, hits, total) in sorted(self.rules.items(), key=lambda x: -x[1][2])]
+        caches = {}
+        for counter, n in self.counters.items():
+            cache, event = counter.split('.', 1)
+            caches.setdefault(cache, {})[event] = n
+        for events in caches.values():
+            if 'miss' in events:
+                events['hit_ratio'] = round(1.0 - float(events['miss']) / sum(events.values()), 3)
+        return {'seconds': round(time.time() - self.started, 3), 'stages': stages, 'rules': rules,
+                'counters': caches}
+
+
+class Stage:
+    """Times a --profile stage, does nothing without --profile"""
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = PROFILE
+
+    def __enter__(self):
+        if self.profile:
+            self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile:
+            self.profile.add(self.name, time.time() - self.started)
+        return False
+
+
+def count(counter):
+    if PROFILE:
+        PROFILE.count(counter)
+
+
 class Config:
-    def __init__(self, config_file):
+    def __init__(self, config_files):
+        """Weights profiles of the config files: [WEIGHTS] sections are named after their
+        files (or "default" for a single file), [WEIGHTS <name>] sections after <name>"""
+
+        self.profiles = OrderedDict()
+        self.filters = []
+
+        for config_file in config_files:
+            config = configparser.ConfigParser()
+            if os.path.exists(config_file):
+                with io.open(config_file, encoding='utf-8') as f:
+                    text, filters = self.split_filters(f.read())
+                config.read_string(text, source=config_file)
+                self.filters += filters
+            for section in config.sections():
+                if section == 'WEIGHTS':
+                    name = 'default' if len(config_files) == 1 else \
+                        os.path.splitext(os.path.basename(config_file))[0]
+                elif section.startswith('WEIGHTS '):
+                    name = section[len('WEIGHTS '):].strip()
+                else:
+                    continue
+                self.profiles[name] = dict(config[section])
 
-        self.weights = {}
+        if not self.profiles:
+            raise KeyError("no WEIGHTS sections in %s" % ", ".join(config_files))
 
-        config = configparser.ConfigParser()
-        config.read(config_file)
-        self.weights.update(config['WEIGHTS'])
+        self.weights = list(self.profiles.values())[0]
+
+    @staticmethod
+    def split_filters(text):
+        """(the config text without the [FILTERS] lines, the filters): "sqm > 60" isn't a "key = value" line"""
+        lines = []
+        filters = []
+        section = None
+        for line in text.splitlines():
+            m = re.match(r'\s*\[(.*)\]\s*$', line)
+            if m:
+                section = m.group(1).strip()
+            elif section == 'FILTERS':
+                if line.strip() and not line.lstrip().startswith(('#', ';')):
+                    filters.append(line.strip())
+                # blank, the line numbers of the parsing errors stay right
+                line = ""
+            lines.append(line)
+        return "\n".join(lines) + "\n", filters
 
 
 HEADER = """
@@ -657,6 +2710,11 @@ $(document).ready(function() {
 """
 
 
+def native(text):
+    """The text as a str, bytes in Python 2: what argparse and sys.exit() write"""
+    return text if isinstance(text, str) else text.encode('utf-8')
+
+
 def parse_args():
     description = ""
 
@@ -666,56 +2724,638 @@ def parse_args():
     parser.add_argument('-l', '--links', help="file with imot.bg/etc apartments links")
     parser.add_argument('-p', '--pages', help="file with imot.bg/etc apartments search pages links")
     parser.add_argument('-w', '--html', help="write to given HTML file")
+    parser.add_argument('--depth', default=1, type=int, help="follow up to DEPTH pages of every search (default: 1)")
+    parser.add_argument('--max-listings', default=None, type=int,
+                        help="stop crawling the search pages after MAX_LISTINGS links")
+    parser.add_argument('--delta', metavar='FILE',
+                        help="write the listings new, re-priced or removed since the previous --delta run to FILE "
+                             "('-' for stdout), fetch only the new listings and --recheck share of the known ones")
+    parser.add_argument('--recheck', default=0.1, type=float,
+                        help="share of the known listings fetched again in a --delta run, checked longest ago first "
+                             "(default: 0.1)")
+    parser.add_argument('--manifest', metavar='FILE',
+                        help="the listings of the previous --delta runs (default: manifest.sqlite in the --delta "
+                             "FILE directory)")
+    parser.add_argument('--watch', metavar='MINUTES', type=float,
+                        help="keep running and poll the --pages searches about every MINUTES, more often on the "
+                             "websites with many new listings, the -w reports are rewritten when the ranking changes")
+    parser.add_argument('--history', metavar='DIR',
+                        help="append the prices, sizes, distances and scores of the listings of every run to the "
+                             "price history in DIR")
+    parser.add_argument('--query', choices=('eur_sqm', 'market', 'drops'),
+                        help="print an aggregate of the --history and exit: median EUR/sqm per district and "
+                             "--period, days on the market per district or the -t (20) biggest price drops")
+    parser.add_argument('--period', choices=('day', 'week', 'month'), default='week',
+                        help="--query eur_sqm period (default: week)")
     parser.add_argument('-r', '--clear-cache', action="store_true", help="clear apartments HTML caches")
+    parser.add_argument('--cache-ttl', default=24, type=float,
+                        help="revalidate cached pages older than CACHE_TTL hours (0 - never, default: 24)")
+    parser.add_argument('--cache-size', default=512, type=int,
+                        help="max pages cache size, MB (0 - unlimited, default: 512)")
+    parser.add_argument('--full-pages', action="store_true",
+                        help="download and cache the whole pages, not only up to the stop words")
+    parser.add_argument('--reparse', action="store_true", help="parse all the pages, ignore the parsed listings store")
+    parser.add_argument('--keep-duplicates', action="store_true",
+                        help="rank the near-duplicate listings separately, don't merge them into one entry")
+    parser.add_argument('-f', '--filter', action='append', metavar='FILTER',
+                        help="skip the listings failing FILTER before geocoding, e.g. \"price<=1500\", "
+                             "\"rooms=2-3\", \"district=Lozenets,Iztok\", \"furniture=yes\"; repeat for several, "
+                             "see also the [FILTERS] config section")
     parser.add_argument('-d', '--distance', help="analyze distance to given location")
-    parser.add_argument('-c', '--config', default='config.txt', help="configuration file")
+    parser.add_argument('--poi', metavar='FILE',
+                        help="score the distances to the points of interest of FILE, \"kind,lat,lon[,name]\" lines, "
+                             "weights <kind>_km and <kind>_500m in the config")
+    parser.add_argument('--gazetteer', metavar='FILE',
+                        help="geocode offline the streets and districts of FILE, \"city,district,street,lat,lon\" "
+                             "lines, the geocoder gets only the addresses not found there")
+    parser.add_argument('--max-distance', default=50.0, type=float, metavar='KM',
+                        help="with -t and -d only the apartments that can make the top are geocoded, assuming no "
+                             "apartment is farther than KM from the -d location (default: 50)")
+    parser.add_argument('--geocoder', help="Nominatim server URL (default: https://nominatim.openstreetmap.org)")
+    parser.add_argument('--geocode-rate', default=1.0, type=float, help="max geocoding requests per second")
+    parser.add_argument('-c', '--config', action='append',
+                        help="configuration file, repeat to rank by several weights profiles (default: config.txt)")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="write the time of every stage and rule and the cache hit ratios as JSON to FILE "
+                             "('-' for stderr)")
+    parser.add_argument('-t', '--top', default=None, type=int, help="report only TOP best apartments")
     parser.add_argument('-n', '--head', default=None, type=int, help="take only HEAD first urls from the file")
+    parser.add_argument('-j', '--jobs', default=1, type=int, help="fetch up to JOBS pages in parallel")
+    parser.add_argument('--host-jobs', default=2, type=int, help="max parallel requests to a single host (with --jobs)")
+    parser.add_argument('--parse-jobs', default=1, type=int,
+                        help="parse the pages in PARSE_JOBS processes, on as many cores (default: 1, no processes)")
+
+    args = parser.parse_args()
+    if args.query and not args.history:
+        parser.error("--query needs the --history directory")
+    for option, jobs in (('--jobs', args.jobs), ('--host-jobs', args.host_jobs), ('--parse-jobs', args.parse_jobs)):
+        if jobs < 1:
+            parser.error("%s must be at least 1" % option)
+    if args.depth < 1:
+        parser.error("--depth must be at least 1")
+    for text in args.filter or []:
+        try:
+            Filter(text)
+        except ValueError as e:
+            parser.error(native("%s" % e))
+    if args.watch is not None:
+        if args.watch <= 0:
+            parser.error("--watch interval must be positive")
+        if not args.pages or not args.html:
+            parser.error("--watch needs the --pages searches and a -w report")
+        if args.delta:
+            parser.error("--watch and --delta can't be used together")
+    return args
+
+
+class Response:
+    """
+    Response of HttpClient, the body is decompressed while it is read. The connection goes back to
+    the pool once the body is read through, or on close() if the rest of the body is short enough
+    to skip it, otherwise it is closed.
+    """
+
+    CHUNK = 16384
+
+    # bytes of the body left unread to skip on close() rather than opening a new connection
+    DRAIN = 65536
+
+    def __init__(self, client, key, conn, raw):
+        self.client = client
+        self.key = key
+        self.conn = conn
+        self.raw = raw
+        self.code = raw.status
+        self.reason = raw.reason
+        self.headers = raw.msg
+        encoding = (raw.getheader('Content-Encoding') or "").lower()
+        # 32 + MAX_WBITS: a gzip or zlib stream, whichever header it has
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS) if encoding in ('gzip', 'deflate') else None
+        # some servers send "deflate" as a raw deflate stream, without the zlib header
+        self.raw_deflate = encoding == 'deflate'
+        self.buffer = b''
+        self.pos = 0
+        self.done = False
+
+    def fill(self):
+        """Add the next chunk of the body to the buffer, False at the end of the body"""
+        while not self.done:
+            chunk = self.raw.read(self.CHUNK)
+            if not chunk:
+                if self.decompressor:
+                    chunk = self.decompressor.flush()
+                self.release()
+            elif self.decompressor:
+                chunk = self.decompress(chunk)
+            if chunk:
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def decompress(self, chunk):
+        try:
+            return self.decompressor.decompress(chunk)
+        except zlib.error:
+            # the header is in the first chunk
+            if not self.raw_deflate:
+                raise
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decompressor.decompress(chunk)
+        finally:
+            self.raw_deflate = False
+
+    def readline(self):
+        while True:
+            end = self.buffer.find(b'\n', self.pos)
+            if end >= 0 or not self.fill():
+                break
+        end = end + 1 if end >= 0 else len(self.buffer)
+        line = self.buffer[self.pos:end]
+        self.pos = end
+        return line
+
+    def read(self):
+        while self.fill():
+            pass
+        data = self.buffer[self.pos:]
+        self.buffer, self.pos = b'', 0
+        return data
+
+    def release(self):
+        self.done = True
+        if self.raw.will_close:
+            self.conn.close()
+        else:
+            self.client.release(self.key, self.conn)
+
+    def close(self):
+        if self.done:
+            return
+        if self.raw.length is not None and self.raw.length <= self.DRAIN:
+            self.raw.read()
+            self.release()
+        else:
+            self.done = True
+            self.conn.close()
+
+
+class HttpClient:
+    """
+    HTTP/1.1 client keeping the connections to every host (or proxy) open between the requests and
+    asking for gzip/deflate compressed pages. The proxies come from the http_proxy, https_proxy and
+    no_proxy environment variables, as with urllib.
+    """
+
+    REDIRECTS = 5
+
+    # idle connections kept per host
+    IDLE = 8
+
+    USER_AGENT = "Python-urllib/%d.%d" % sys.version_info[:2]
+
+    def __init__(self, timeout=60.0):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def route(self, url):
+        """(scheme, host, port, tunnel) of the connection for the url and the request target"""
+        u = urlparse(url)
+        port = u.port or (443 if u.scheme == 'https' else 80)
+        target = (u.path or "/") + ("?" + u.query if u.query else "")
+        proxy = getproxies().get(u.scheme)
+        if not proxy or proxy_bypass(u.hostname):
+            return (u.scheme, u.hostname, port, None), target
+        p = urlparse(proxy if "://" in proxy else "http://" + proxy)
+        if u.scheme == 'https':
+            return ('https', p.hostname, p.port or 80, (u.hostname, port)), target
+        return ('http', p.hostname, p.port or 80, None), url
+
+    def connection(self, key):
+        """(connection, True if it is an idle one)"""
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port, tunnel = key
+        if scheme == 'https':
+            conn = HTTPSConnection(str(host), port, timeout=self.timeout)
+            if tunnel:
+                conn.set_tunnel(str(tunnel[0]), tunnel[1])
+        else:
+            conn = HTTPConnection(str(host), port, timeout=self.timeout)
+        return conn, False
+
+    def release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.IDLE:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close the idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def get(self, url, headers=None):
+        key, target = self.route(url)
+        request = {str('Accept-Encoding'): str('gzip, deflate'), str('User-Agent'): str(self.USER_AGENT)}
+        request.update((str(k), str(v)) for k, v in (headers or {}).items())
+        while True:
+            conn, reused = self.connection(key)
+            try:
+                conn.request(str('GET'), str(target), headers=request)
+                raw = conn.getresponse()
+            except (IOError, HTTPException):
+                conn.close()
+                if reused:
+                    # the server has closed the idle connection, try another one
+                    continue
+                raise
+            count('connections.hit' if reused else 'connections.miss')
+            return Response(self, key, conn, raw)
+
+    def open(self, url, headers=None):
+        """Response to a GET of the url, redirects are followed, HTTPError for 304 and the errors"""
+        for _ in range(self.REDIRECTS + 1):
+            response = self.get(url, headers)
+            location = response.headers.get('Location')
+            if response.code in (301, 302, 303, 307, 308) and location:
+                response.close()
+                url = urljoin(url, location)
+                continue
+            if response.code >= 300:
+                response.close()
+                raise HTTPError(url, response.code, response.reason, response.headers, None)
+            return response
+        raise HTTPError(url, response.code, "too many redirects", response.headers, None)
 
-    return parser.parse_args()
 
+# the connections to the websites, see HttpClient
+HTTP = HttpClient()
 
-def url_open(url):
-    for retry in range(0, 5):
+
+def backoff(retry, retry_after=None):
+    """Seconds to wait before the next attempt: the Retry-After of the server (seconds or a date) if given,
+    else BACKOFF doubled with every retry, half of it random so parallel requests don't retry at once"""
+    if retry_after:
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            date = email.utils.parsedate_tz(retry_after)
+            seconds = email.utils.mktime_tz(date) - time.time() if date else None
+        if seconds is not None:
+            return min(max(seconds, 0.0), BACKOFF_MAX)
+    wait = min(BACKOFF * 2 ** retry, BACKOFF_MAX)
+    return wait / 2 + random.uniform(0, wait / 2)
+
+
+def url_open(url, headers=None):
+    """HTTP.open() retrying the network errors, 429 and 5xx responses, the last error is passed on"""
+    for retry in range(RETRIES):
         try:
-            return urlopen(url)
-        except HTTPError as e:
+            return HTTP.open(url, headers)
+        except (IOError, HTTPException) as e:
+            code = getattr(e, 'code', None)
+            if retry + 1 == RETRIES or code == 304 or (code and code < 500 and code != 429):
+                raise
             logging.warning("can't fetch: %s - %s" % (url, str(e)))
-            time.sleep(1.0)
-    raise
-
+            count('fetch.retries')
+            time.sleep(backoff(retry, e.hdrs.get('Retry-After') if code and e.hdrs else None))
+
+
+def read_page(response, site=None, charset=None):
+    """The response body, only up to the line with a stop word of the site if given"""
+    if site is None:
+        return response.read()
+    lines = []
+    for line in iter(response.readline, b''):
+        lines.append(line)
+        if site.isStop(line, charset):
+            count('download.truncated')
+            response.close()
+            break
+    return b''.join(lines)
+
+
+def read_searches(args):
+    return [l.strip() for l in open(args.pages).readlines()[0:args.head] if l.strip().startswith("http")]
+
+
+class Links:
+    """
+    The apartment links of the -l file, then those the Crawler finds on the -p searches. Once they are all
+    taken, complete tells if they are all the listings there are: --head left no lines out and the crawl
+    was complete.
+    """
+
+    def __init__(self, args, limits=None):
+        self.links = []
+        self.cut = False
+        if args.links:
+            with open(args.links) as f:
+                lines = f.readlines()
+            for l in lines[0:args.head]:
+                self.links.append(l.strip())
+            self.cut = any(l.strip() for l in lines[len(self.links):])
+
+        self.crawler = None
+        if args.pages:
+            if args.head is not None:
+                with open(args.pages) as f:
+                    self.cut = self.cut or any(l.strip().startswith("http") for l in f.readlines()[args.head:])
+            self.crawler = Crawler(read_searches(args), args.depth, args.max_listings, args.jobs, limits,
+                                   seen=self.links)
+
+    def __iter__(self):
+        for link in self.links:
+            yield link
+
+        if self.crawler:
+            for link in self.crawler:
+                yield link
+
+    @property
+    def complete(self):
+        return not self.cut and (self.crawler is None or self.crawler.complete)
+
+
+def find_links(args, limits=None):
+    return Links(args, limits)
+
+
+def scan_links(links, apartments, args, limits, duplicates=None, geocoder=None, manifest=None, parser=None):
+    """
+    Fetch and parse the apartments of the links, appended to apartments, merge the duplicates and start geocoding
+    their addresses. Returns {url: (change, previous price)} of the fetched apartments in a --delta run.
+    """
+    def found():
+        for link in links:
+            if manifest and not manifest.due(link):
+                continue
+            apartments.append(Apartment(len(apartments) + 1, link))
+            yield apartments[-1]
 
-def find_links(args):
-    links = []
+    # the known listings are fetched in delta mode to see if they changed
+    revalidate = manifest is not None
 
-    if args.links:
-        for l in open(args.links).readlines()[0:args.head]:
-            links.append(l.strip())
+    fetcher = None
+    if args.jobs > 1:
+        fetcher = Fetcher(args.jobs, limits, revalidate)
+        pages = fetcher.imap(found())
+    else:
+        pages = ((a, a.getPage(revalidate)) for a in found())
 
-    if args.pages:
-        seen = set()
+    # the pages are parsed in the parser processes while the next ones are being fetched
+    if parser:
+        scanned = parser.imap(pages, manifest is not None)
+    else:
+        scanned = ((a, a.scanPage(page, manifest is not None)) for a, page in pages)
 
-        for l in open(args.pages).readlines()[0:args.head]:
-            url = l.strip()
-            if not url.startswith("http"):
+    changes = {}
+    for a, digest in scanned:
+        if manifest:
+            changes[a.url] = manifest.update(a.url, a.price, digest)
+            if not changes[a.url][0]:
                 continue
+        if FILTERS:
+            failed = FILTERS.rejects(a)
+            if failed:
+                logging.info("filtered out by %s: %s" % (failed.text, a.url))
+                count('filters.rejected')
+                a.rejected = True
+                continue
+        if duplicates:
+            with Stage('dedup'):
+                canonical = duplicates.canonical(a)
+            if canonical:
+                logging.info("duplicate of %s: %s" % (canonical.url, a.url))
+                count('duplicates.merged')
+                canonical.merge(a)
+                # only the addresses the duplicate adds
+                a = canonical
+        if geocoder:
+            geocoder.submit(a)
+
+    if fetcher:
+        fetcher.close()
+    return changes
+
+
+def listed(apartments, duplicates=None):
+    """The apartments to rank: not filtered out nor merged into another one"""
+    return [a for a in apartments if not a.rejected and not (duplicates and a.id in duplicates.merged)]
+
+
+def lazy_geocoding(args, location):
+    """True if only the apartments that can make the -t top are geocoded, see geocode_top()"""
+    return bool(args.top and location and not POIS)
+
+
+def geocode_top(apartments, profiles, top, geocoder, location, max_km):
+    """
+    Geocode only the apartments that can make the top of a ranking. Until geocoded, the distance of an
+    apartment can be anything from 0 to max_km (or unknown, SCORE_DEFAULTS), so its score is within bounds.
+    The apartments whose upper bound reaches the top-th best lower bound of a profile (the cutoff) are
+    geocoded, the most promising first, top at a time, and the cutoffs rise with their exact scores until
+    no other apartment can make the top. The tops are the same as with all the apartments geocoded as long
+    as no apartment is farther than max_km (always for the negative distance weights).
+    """
+    column = SCORE_ATTRS.index('distance')
+    weights = [[float(w.get(attr, 0)) for attr in SCORE_ATTRS] for w in profiles.values()]
+    # (min, max) of the distance term of every profile
+    terms = [sorted((0.0, w[column] * max(max_km, SCORE_DEFAULTS['distance']))) for w in weights]
+
+    unknown = set()
+    for i, a in enumerate(apartments):
+        if geocoder.submit(a, lazy=True):
+            unknown.add(i)
+        else:
+            a.initDistance(location)
+    features = [a.features() for a in apartments]
+    # the scores without the distance term
+    base = [[sum(f * x for j, (f, x) in enumerate(zip(row, w)) if j != column) for w in weights] for row in features]
+
+    def bounds(i, p):
+        if i in unknown:
+            return base[i][p] + terms[p][0], base[i][p] + terms[p][1]
+        exact = base[i][p] + weights[p][column] * features[i][column]
+        return exact, exact
+
+    total = len(unknown)
+    while unknown:
+        candidates = {}
+        for p in range(len(weights)):
+            lows = [bounds(i, p)[0] for i in range(len(apartments))]
+            cutoff = heapq.nlargest(top, lows)[-1] if len(lows) >= top else float('-inf')
+            # the ranked scores are summed in another order
+            cutoff -= 1e-9 * (1 + abs(cutoff))
+            for i in sorted(unknown):
+                high = bounds(i, p)[1]
+                if high >= cutoff:
+                    candidates[i] = max(candidates.get(i, float('-inf')), high - cutoff)
+        if not candidates:
+            break
+        batch = heapq.nlargest(top, sorted(candidates), key=candidates.get)
+        for i in batch:
+            geocoder.submit(apartments[i])
+        geocoder.join()
+        for i in batch:
+            apartments[i].initDistance(location)
+            features[i] = apartments[i].features()
+            unknown.discard(i)
+    logging.info("geocoded %d of %d apartments not geocoded yet, the others can't make the top %d"
+                 % (total - len(unknown), total, top))
+
+
+def rankings(apartments, args, config, geocoder=None, location=None):
+    """[(profile, [(score, apartment)])] of the apartments, once their addresses are geocoded (only those that
+    can make the top with lazy_geocoding())"""
+    if lazy_geocoding(args, location):
+        geocode_top(apartments, config.profiles, args.top, geocoder, location, args.max_distance)
+    else:
+        if geocoder:
+            geocoder.join()
+        if location:
+            for a in apartments:
+                a.initDistance(location)
+    if POIS:
+        with Stage('poi'):
+            POIS.measure(apartments)
 
-            logging.info("open apartments search page list: %s" % url)
-            data = url_open(url)
-            for l in data.readlines():
-                for r in reApartmentLink:
-                    m = r.search(l)
-                    if not m:
-                        continue
-                    link = m.group(1)
-                    if link in seen:
-                        continue
-                    seen.add(link)
-                    logging.debug("  found apartment link: %s" % link)
-                    if not link.startswith("http"):
-                        link = "http://" + link
-                    links.append(link)
+    with Stage('score'):
+        return list(rank(apartments, config.profiles, args.top))
+
+
+def write_report(f, ranking):
+    """Write the HTML report of the [(score, apartment)] ranking to the file, row by row"""
+    f.write(HEADER)
+    f.write(Apartment.toHtmlHeader())
+
+    for score, a in ranking:
+        a.score = score
+        f.write(a.toHtml())
 
-    return links
+    f.write(Apartment.toHtmlFooter())
+
+    f.write("<script>var images = {")
+    for n, (_, a) in enumerate(ranking):
+        f.write("%s\"%d\": '%s'" % (", " if n else "", a.id, a.getBigImages()))
+    f.write("};</script>")
+
+    f.write(FOOTER)
+
+
+def write_delta(f, apartments, changes, removed):
+    """Write the new, re-priced and removed listings, a line per listing"""
+    for a in apartments:
+        change, old_price = changes[a.url]
+        if change == "new":
+            f.write("new\t%d\t%s\n" % (a.price, a.url))
+    for a in apartments:
+        change, old_price = changes[a.url]
+        if change == "repriced":
+            f.write("repriced\t%d -> %d\t%s\n" % (old_price, a.price, a.url))
+    for url, price in removed:
+        f.write("removed\t%d\t%s\n" % (price or 0, url))
+
+
+def report_file(path):
+    """The report file to write, stdout if the path is None"""
+    if path is None:
+        sys.stdout.flush()
+        return io.open(sys.stdout.fileno(), 'w', encoding=REPORT_CHARSET, errors='xmlcharrefreplace', closefd=False)
+    return io.open(path, 'w', encoding=REPORT_CHARSET, errors='xmlcharrefreplace')
+
+
+def profile_path(path, profile):
+    """Report file name for the ranking by the given profile: report.html -> report-<profile>.html"""
+    base, ext = os.path.splitext(path)
+    return "%s-%s%s" % (base, re.sub(r'[^\w.-]+', '_', profile), ext)
+
+
+def replace_file(src, dst):
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def write_reports(args, ranked, atomic=False):
+    """
+    Write the report of every profile ranking. An atomic report is written to a temporary file first,
+    so a browser reloading it never gets it half-written.
+    """
+    for p, (name, ranking) in enumerate(ranked):
+        if p and not args.html:
+            logging.warning("'%s' profile ranking skipped, use -w to write all the rankings" % name)
+            continue
+        path = profile_path(args.html, name) if p else args.html
+        with Stage('report'):
+            with report_file(path + '.part' if atomic else path) as f:
+                write_report(f, ranking)
+                if not args.html:
+                    f.write("\n")
+            if atomic:
+                replace_file(path + '.part', path)
+
+
+def write_profile(args):
+    summary = json.dumps(PROFILE.summary(), indent=2, sort_keys=True)
+    if args.profile == '-':
+        sys.stderr.write(summary + "\n")
+    else:
+        with open(args.profile, 'w') as f:
+            f.write(summary + "\n")
+
+
+def ranking_state(ranked):
+    """What the reports of the rankings show, to see if they have to be written again"""
+    return [(name, [(score, a.id, len(a.duplicates or ())) for score, a in ranking]) for name, ranking in ranked]
+
+
+def watch(args, config, limits, apartments, duplicates=None, geocoder=None, location=None, ranked=None, parser=None,
+          history=None):
+    """
+    Poll the searches of every website on the PollSchedule and scan their new listings, the searches end
+    at the first page without new links, so a poll without news costs a page per search. The caches,
+    parsed apartments and geocoded location stay in memory, the reports are rewritten when the ranking
+    changes and every round of polls is added to the history. Runs till interrupted.
+    """
+    searches = OrderedDict()
+    for url in read_searches(args):
+        searches.setdefault(urlparse(url).netloc.lower(), []).append(url)
+    schedule = PollSchedule(searches, args.watch * 60, time.time())
+    state = ranking_state(ranked or [])
+    eager = None if lazy_geocoding(args, location) else geocoder
+
+    while True:
+        time.sleep(schedule.wait(time.time()))
+        for host in schedule.due(time.time()):
+            started = time.time()
+            before = len(apartments)
+            crawler = Crawler(searches[host], args.depth, args.max_listings, args.jobs, limits,
+                              seen=[a.url for a in apartments], polling=True)
+            scan_links(crawler, apartments, args, limits, duplicates, eager, parser=parser)
+            new = len(apartments) - before
+            interval = schedule.update(host, new, started)
+            logging.info("%s: %d new listings, next poll in %.1f minutes" % (host, new, interval / 60))
+        HTTP.close()
+
+        current = listed(apartments, duplicates)
+        ranked = rankings(current, args, config, geocoder, location)
+        if ranking_state(ranked) != state:
+            write_reports(args, ranked, atomic=True)
+            state = ranking_state(ranked)
+        if history:
+            history.append(current, ranked)
+        if PROFILE:
+            write_profile(args)
 
 
 def main():
@@ -727,55 +3367,139 @@ def main():
     else:
         logging.basicConfig(format=fmt, level=logging.INFO if args.verbose else logging.ERROR, filename=None)
 
+    if args.query:
+        if numpy is None:
+            sys.exit("--query needs NumPy")
+        header, rows = history_query(History(args.history), args.query, args.period, args.top)
+        for row in [header] + rows:
+            print("\t".join("%s" % v for v in row))
+        return
+
+    global PROFILE
+    if args.profile:
+        PROFILE = Profile()
+
+    config = Config(args.config or ['config.txt'])
+
+    global FILTERS
+    if config.filters or args.filter:
+        try:
+            FILTERS = Filters(config.filters + (args.filter or []))
+        except ValueError as e:
+            sys.exit(native("[FILTERS]: %s" % e))
+
+    # the parser processes are forked before any thread is started or cache opened, with the filters
+    parser = None
+    if args.parse_jobs > 1:
+        parser = Parser(args.parse_jobs)
+
     if args.clear_cache:
         shutil.rmtree(CACHE_DIR)
     if not os.path.exists(CACHE_DIR):
         os.mkdir(CACHE_DIR)
 
-    if args.distance:
-        geolocator = geocoders.Nominatim(user_agent="aparts-scanner-2")
-        try:
-            _, location = geolocator.geocode(args.distance, language="bg-BG")
-        except GeocoderQuotaExceeded as e:
-            logging.warning(str(e))
-            logging.warning("distance calculation will be disabled")
-            args.distance = False
-
-    config = Config(args.config)
-
-    apartments = []
+    global PAGES
+    PAGES = PageCache(os.path.join(CACHE_DIR, 'pages.sqlite'), args.cache_ttl * 3600, args.cache_size * 1024 * 1024)
 
-    n = 1
-    for l in find_links(args):
-        a = Apartment(n, l.strip())
-        a.scan()
-        if args.distance:
-            a.initDistance(geolocator, location, args.distance)
-        a.calcScore(config.weights)
-        apartments.append(a)
-        n += 1
+    global GEOCODES
+    GEOCODES = GeoCache(os.path.join(CACHE_DIR, 'geocodes.sqlite'))
 
-    html = HEADER
-    html += Apartment.toHtmlHeader()
+    global FULL_PAGES
+    FULL_PAGES = args.full_pages
 
-    apartments = sorted(apartments, key=lambda x: x.score, reverse=True)
-    for a in apartments:
-        html += a.toHtml()
+    global LISTINGS
+    if not args.reparse:
+        LISTINGS = ListingStore(os.path.join(CACHE_DIR, 'listings.sqlite'), parser_version())
 
-    html += Apartment.toHtmlFooter()
+    global POIS
+    if args.poi:
+        if numpy is None:
+            logging.warning("--poi needs NumPy, the points of interest will be ignored")
+        else:
+            POIS = Pois(args.poi)
+
+    geocoder = None
+    location = None
+    if args.distance or POIS:
+        if args.geocoder:
+            u = urlparse(args.geocoder)
+            geolocator = geocoders.Nominatim(user_agent="aparts-scanner-2", domain=u.netloc, scheme=u.scheme)
+        else:
+            geolocator = geocoders.Nominatim(user_agent="aparts-scanner-2")
+        gazetteer = Gazetteer(args.gazetteer) if args.gazetteer else None
+        geocoder = GeocodeScheduler(geolocator, args.geocode_rate, gazetteer)
+    if args.distance:
+        try:
+            location = geocoder.geocode(args.distance)
+        except GeopyError as e:
+            logging.warning(str(e))
+            location = None
+        if not location:
+            logging.warning("distance calculation will be disabled")
+            if not POIS:
+                geocoder = None
+
+    limits = HostLimits(args.host_jobs)
+
+    manifest = None
+    if args.delta:
+        path = args.manifest or os.path.join(os.path.dirname(args.delta) if args.delta != '-' else '',
+                                             'manifest.sqlite')
+        # the manifest used to be kept with the caches, which -r clears
+        old = os.path.join(CACHE_DIR, 'manifest.sqlite')
+        if not os.path.exists(path) and os.path.exists(old):
+            shutil.move(old, path)
+        manifest = Manifest(path, args.recheck)
+
+    duplicates = None if args.keep_duplicates else Duplicates()
+
+    # the apartments are scanned while the search pages are still being crawled
+    scanned = []
+    # with lazy geocoding the addresses are geocoded after the scan, only those that can make the top
+    eager = None if lazy_geocoding(args, location) else geocoder
+    links = find_links(args, limits)
+    changes = scan_links(links, scanned, args, limits, duplicates, eager, manifest, parser)
+    HTTP.close()
+
+    apartments = listed(scanned, duplicates)
+    history = History(args.history) if args.history else None
+
+    if manifest:
+        removed = []
+        if links.complete:
+            removed = manifest.removed()
+        else:
+            # the listings not found may well be on the pages not fetched
+            logging.warning("the search pages weren't all fetched (errors, --head, --depth or --max-listings), "
+                            "no listing is taken for removed")
+        manifest.save()
+        # the report has only the new and re-priced apartments
+        apartments = [a for a in apartments if changes[a.url][0]]
+        if args.delta == '-':
+            write_delta(sys.stdout, apartments, changes, removed)
+        else:
+            with io.open(args.delta, 'w', encoding='utf-8') as f:
+                write_delta(f, apartments, changes, removed)
 
-    html += "<script>var images = {"
-    html += ", ".join(["\"%d\": '%s'" % (a.id, a.getBigImages()) for a in apartments])
-    html += "};</script>"
+    ranked = rankings(apartments, args, config, geocoder, location)
+    write_reports(args, ranked, atomic=args.watch is not None)
+    if history:
+        # all the listings, the delta report's too, and those a delta run didn't fetch
+        history.append(listed(scanned, duplicates) + (history.carried(manifest.skipped()) if manifest else []), ranked)
 
-    html += FOOTER
+    if PROFILE:
+        write_profile(args)
 
-    if args.html:
-        f = open(args.html, 'w')
-        f.write(html)
-        f.close
-    else:
-        print(html)
+    if args.watch is not None:
+        try:
+            watch(args, config, limits, scanned, duplicates, geocoder, location, ranked, parser, history)
+        except KeyboardInterrupt:
+            logging.info("watching stopped")
+        finally:
+            HTTP.close()
+
+    if parser:
+        parser.close()
 
 
 if __name__ == '__main__':